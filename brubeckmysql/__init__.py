@@ -4,4 +4,4 @@
 
 version = "0.2.7"
 version_info = (0, 2, 8)
-__all__ = [ 'querysets', 'base']
+__all__ = [ 'querysets', 'base', 'profiler', 'cache', 'loadtest', 'handlers']
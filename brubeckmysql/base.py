@@ -3,8 +3,21 @@
 # Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
 # the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
 
-import pymysql
+import os
+import time
+import random
+import socket
 import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pymysql
+import gevent
+import gevent.lock
+import gevent.queue
 
 ##
 ## This is a method so we can create our DB connection and pass it to the application, the proper Brubeck way.
@@ -21,12 +34,90 @@ mysql = {
         "PASSWORD": "[YOUR PASSWORD HERE]", ## MySQL Password
         "DATABASE": "[YOUR DATABASE HERE]", ## Database Name
         "COLLATION": 'utf8',               ## Database Collation
+        "INIT_COMMAND": None,              ## Optional SQL run once as part of connecting
+        "MAX_ALLOWED_PACKET": None,        ## Largest packet in bytes, raise it for big rows
+        "SOCKET_RCVBUF": None,             ## Socket receive buffer in bytes, fixes it (no autotuning), see set_socket_buffers
+        "SOCKET_SNDBUF": None,             ## Socket send buffer in bytes, fixes it (no autotuning), see set_socket_buffers
+    },
+    "BULK": {                              ## Optional separate pool for bulk reads (bulk=True)
+        "CONNECTION": {"MAX_ALLOWED_PACKET": 67108864}, ## Overrides CONNECTION
+        "POOL": {"SIZE": 2},               ## Overrides POOL
+    },
+    "POOL": {
+        "SIZE": 10,                        ## Max connections in the pool
+        "MODE": "gevent",                  ## "gevent" (gevent Queue) or "thread" (thread-safe LIFO)
+        "MIN": None,                       ## Connections to open before serving, the rest fill in the background
+        "FILL_CONCURRENCY": 10,            ## Connections opened at once while filling
+    },
+    "RECONNECT": {
+        "MAX_CONCURRENT": 2,               ## Connection attempts in flight at once, per pool
+        "MAX_RETRIES": 3,                  ## Attempts per reconnect before giving up
+        "BACKOFF_BASE": 0.1,               ## Seconds, doubled on every retry
+        "BACKOFF_MAX": 5.0,                ## Seconds, cap for the backoff (full jitter is applied)
+        "FAILURE_THRESHOLD": 5,            ## Consecutive failures that open the circuit
+        "RESET_TIMEOUT": 10.0,             ## Seconds the circuit stays open before a half-open probe
     }
+}
+
+##
+## For a ShardedMySqlApiQueryset add one CONNECTION block per shard.
+## The order matters, a shard is its index in this list.
+##
+mysql_sharded = {
+    "SHARDS": [
+        {"HOST": "127.0.0.1", "PORT": 3306, "USER": "...", "PASSWORD": "...",
+         "DATABASE": "...", "COLLATION": 'utf8'},
+        {"HOST": "127.0.0.1", "PORT": 3307, "USER": "...", "PASSWORD": "...",
+         "DATABASE": "...", "COLLATION": 'utf8'},
+    ],
+    "POOL": {...},
+    "TABLES": {...},
+}
 """
 
+POOL_MODE_GEVENT = "gevent"
+POOL_MODE_THREAD = "thread"
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenException(Exception):
+    """Raised instead of connecting while the MySQL backend is considered down"""
+    pass
+
+
+class ConfigurationException(Exception):
+    """Raised for CONNECTION settings we can never connect with, before
+    any attempt is made, so they are not retried or counted as failures
+    """
+    pass
+
+
+def check_connection_settings(settings):
+    """raise ConfigurationException for CONNECTION settings our driver
+    can not honour
+    """
+    connection = settings["CONNECTION"]
+    if connection.get("COMPRESS"):
+        # pymysql does not implement the compressed protocol
+        raise ConfigurationException("CONNECTION COMPRESS is not supported by pymysql")
+    max_allowed_packet = connection.get("MAX_ALLOWED_PACKET")
+    if max_allowed_packet is not None:
+        try:
+            max_allowed_packet = int(max_allowed_packet)
+        except (TypeError, ValueError):
+            max_allowed_packet = 0
+        if max_allowed_packet <= 0:
+            raise ConfigurationException("CONNECTION MAX_ALLOWED_PACKET must be a positive number, got %r" %
+                                         connection["MAX_ALLOWED_PACKET"])
+
+
 def create_db_conn(settings):
     """create our MySQL connection"""
     logging.debug("create_db_conn")
+    check_connection_settings(settings)
     db_conn = None
     try:
         # Only create it if it doesn't exist
@@ -43,30 +134,32 @@ def create_db_conn(settings):
             if "CA" in settings["CONNECTION"]["SSL"]:
                 ssl["ca"] = settings["CONNECTION"]["SSL"]["CA"]
 
+        # the charset is sent in the handshake, so the server sets
+        # character_set_client, _connection and _results for us without
+        # any extra SET round trips. Anything else goes in INIT_COMMAND.
+        # max_allowed_packet is only passed when set, not every driver
+        # version knows it
+        protocol = {}
+        if settings["CONNECTION"].get("MAX_ALLOWED_PACKET") is not None:
+            protocol["max_allowed_packet"] = int(settings["CONNECTION"]["MAX_ALLOWED_PACKET"])
+
         db_conn = pymysql.connect(
             host        =settings["CONNECTION"]["HOST"],
             port        =settings["CONNECTION"]["PORT"],
             user        =settings["CONNECTION"]["USER"],
             passwd      =settings["CONNECTION"]["PASSWORD"],
             db          =settings["CONNECTION"]["DATABASE"],
-            charset     =settings["CONNECTION"]["COLLATION"],
+            charset     =coll,
             ssl         =ssl,
             use_unicode = True if coll == "utf8" else False,
+            init_command=settings["CONNECTION"].get("INIT_COMMAND"),
+            **protocol
         );
 
-        if settings["CONNECTION"]["COLLATION"] == "utf8":
-            cursor = None
-            try:
-                db_conn.set_charset(coll)
-                cursor = db_conn.cursor()
-                cursor.execute('SET NAMES %s;' % coll)
-                cursor.execute('SET CHARACTER SET %s;' % coll)
-                cursor.execute('SET character_set_connection=%s;' % coll)
-            finally:
-                if cursor is not None:
-                    cursor.close()
-                    db_conn.commit()
+        set_socket_buffers(db_conn, settings)
 
+        # remember who created us, a forked child must not reuse our socket
+        db_conn.creator_pid = os.getpid()
         logging.debug("created db_conn")
 
     except Exception:
@@ -74,28 +167,658 @@ def create_db_conn(settings):
         raise
     return db_conn
 
-def create_db_conn_pool(settings, pool_size=10):
-    """create our MySQL connection"""
+def set_socket_buffers(db_conn, settings):
+    """apply CONNECTION SOCKET_RCVBUF and SOCKET_SNDBUF to db_conn's socket.
+    Leave them unset unless you have measured a need. On Linux setting a
+    buffer locks its size: autotuning (up to net.ipv4.tcp_rmem / tcp_wmem
+    max, often several MB) is turned off and the value is capped at
+    net.core.rmem_max / wmem_max. We set them after connecting, so the
+    TCP window scale was already chosen from the default buffer.
+    """
+    rcvbuf = settings["CONNECTION"].get("SOCKET_RCVBUF")
+    sndbuf = settings["CONNECTION"].get("SOCKET_SNDBUF")
+    if rcvbuf is None and sndbuf is None:
+        return
+    # older pymysql calls it socket, newer _sock
+    sock = getattr(db_conn, '_sock', None) or getattr(db_conn, 'socket', None)
+    if sock is None:
+        logging.debug("no socket found to set buffer sizes on")
+        return
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+def is_db_conn_inherited(db_conn):
+    """True if db_conn was created in another process (we were forked)"""
+    return getattr(db_conn, 'creator_pid', os.getpid()) != os.getpid()
+
+def create_db_conn_pool(settings, pool_size=None, mode=None):
+    """create our MySQL connection pool and fill it.
+    If POOL MIN is set we return once MIN connections are open
+    and fill the rest in the background.
+    """
     logging.debug("create_db_conn_pool")
-    self.db_conn = gevent.queue.Queue()
-    for i in range(pool_size):
-        db_conn = None
+    db_pool = DbPool(settings, pool_size, mode)
+    min_size = settings.get("POOL", {}).get("MIN")
+    if min_size is None or min_size >= db_pool.pool_size:
+        db_pool.fill()
+    else:
+        db_pool.fill(min_size)
+        db_pool.fill_async()
+    return db_pool
+
+
+class ReconnectManager(object):
+    """Controls how we (re)connect to MySQL so a failover does not turn
+    into a reconnect storm.
+
+    At most MAX_CONCURRENT connection attempts run at once, failed attempts
+    are retried with exponential backoff and full jitter, and after
+    FAILURE_THRESHOLD consecutive failures the circuit opens: callers fail
+    fast with CircuitOpenException until RESET_TIMEOUT has passed, then a
+    single half-open probe decides whether to close it again.
+    """
+
+    def __init__(self, settings, mode=None):
+        reconnect_settings = settings.get("RECONNECT", {})
+        if mode is None:
+            mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        self.settings = settings
+        self.mode = mode
+        self.max_concurrent = reconnect_settings.get("MAX_CONCURRENT", 2)
+        self.max_retries = reconnect_settings.get("MAX_RETRIES", 3)
+        self.backoff_base = reconnect_settings.get("BACKOFF_BASE", 0.1)
+        self.backoff_max = reconnect_settings.get("BACKOFF_MAX", 5.0)
+        self.failure_threshold = reconnect_settings.get("FAILURE_THRESHOLD", 5)
+        self.reset_timeout = reconnect_settings.get("RESET_TIMEOUT", 10.0)
+        if mode == POOL_MODE_THREAD:
+            self._semaphore = threading.BoundedSemaphore(self.max_concurrent)
+        else:
+            self._semaphore = gevent.lock.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = None
+        self.consecutive_failures = 0
+        self._probing = False
+        # counters for metrics
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    def _sleep(self, seconds):
+        if self.mode == POOL_MODE_THREAD:
+            time.sleep(seconds)
+        else:
+            gevent.sleep(seconds)
+
+    def _backoff(self, attempt):
+        """full jitter: anywhere between 0 and the capped exponential delay"""
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * (2 ** attempt)))
+
+    def _allow(self):
+        """check the circuit, returns True if this caller is the half-open probe"""
+        with self._lock:
+            if self.state == CIRCUIT_OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenException("MySQL circuit open, not connecting")
+                logging.debug("ReconnectManager circuit half open, probing")
+                self.state = CIRCUIT_HALF_OPEN
+            if self.state == CIRCUIT_HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpenException("MySQL circuit half open, probe in flight")
+                self._probing = True
+                return True
+            return False
+
+    def _on_success(self):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != CIRCUIT_CLOSED:
+                logging.debug("ReconnectManager circuit closed")
+            self.state = CIRCUIT_CLOSED
+            self.opened_at = None
+
+    def _on_failure(self):
+        """record a failed attempt, returns True if the circuit is now open"""
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if (self.state == CIRCUIT_HALF_OPEN or
+                self.consecutive_failures >= self.failure_threshold):
+                if self.state != CIRCUIT_OPEN:
+                    logging.debug("ReconnectManager circuit open")
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.time()
+                self._probing = False
+                return True
+            return False
+
+    def _recheck(self):
+        """the circuit may have opened while we waited for our turn"""
+        with self._lock:
+            if self.state != CIRCUIT_CLOSED:
+                self.rejected += 1
+                raise CircuitOpenException("MySQL circuit opened while waiting to connect")
+
+    def connect(self, limit=True):
+        """create a new connection within our limits.
+        limit=False skips MAX_CONCURRENT but still honours the circuit,
+        for filling a pool which has its own FILL_CONCURRENCY.
+        Bad settings raise ConfigurationException before the circuit is
+        touched, no retry can fix them.
+        """
+        check_connection_settings(self.settings)
+        probe = self._allow()
+        try:
+            if limit:
+                self._semaphore.acquire()
+            try:
+                if not probe:
+                    self._recheck()
+                return self._attempt(probe)
+            finally:
+                if limit:
+                    self._semaphore.release()
+        finally:
+            if probe:
+                # the probe may die without reporting (gevent.Timeout,
+                # GreenletExit), let the next caller probe instead
+                with self._lock:
+                    self._probing = False
+
+    def _attempt(self, probe):
+        """try to connect, with retries unless we are the half-open probe"""
+        retries = 1 if probe else max(self.max_retries, 1)
+        with self._lock:
+            self.in_flight += 1
         try:
-            # Only create it if it doesn't exist
-            # logging.debug("creating db_conn")
-            ## create our mySql connection
-            db_conn = pymysql.connect(
-                host    =settings["CONNECTION"]["HOST"],
-                port    =settings["CONNECTION"]["PORT"],
-                user    =settings["CONNECTION"]["USER"],
-                passwd  =settings["CONNECTION"]["PASSWORD"],
-                db      =settings["CONNECTION"]["DATABASE"]
-            );
-            logging.debug("created db_conn %s" % i)
-            self.db_conn.put_nowait(db_conn)
-            logging.debug("added db_conn %s to pool" % i)
+            attempt = 0
+            while True:
+                with self._lock:
+                    self.attempts += 1
+                try:
+                    db_conn = create_db_conn(self.settings)
+                except ConfigurationException:
+                    raise
+                except Exception:
+                    attempt += 1
+                    if self._on_failure() or attempt >= retries:
+                        raise
+                    delay = self._backoff(attempt)
+                    logging.debug("ReconnectManager retrying in %.3fs" % delay)
+                    self._sleep(delay)
+                    # someone else may have given up on the backend while we slept
+                    self._recheck()
+                    continue
+                self._on_success()
+                return db_conn
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        """our circuit state and counters, for metrics"""
+        return {
+            "state": self.state,
+            "opened_at": self.opened_at,
+            "consecutive_failures": self.consecutive_failures,
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+        }
+
+
+def spawn(func, mode=POOL_MODE_GEVENT, *args):
+    """run func in the background, a greenlet or a daemon thread"""
+    if mode == POOL_MODE_THREAD:
+        worker = threading.Thread(target=func, args=args)
+        worker.daemon = True
+        worker.start()
+        return worker
+    return gevent.spawn(func, *args)
+
+def run_parallel(funcs, mode=POOL_MODE_GEVENT):
+    """call each function concurrently (greenlets, or threads in thread mode)
+    and return their results in the same order. Raises the first error.
+    """
+    results = [None] * len(funcs)
+    errors = []
+    def run(i):
+        try:
+            results[i] = funcs[i]()
+        except Exception as e:
+            errors.append(e)
+    if len(funcs) == 1:
+        run(0)
+    elif mode == POOL_MODE_THREAD:
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(len(funcs))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        gevent.joinall([gevent.spawn(run, i) for i in range(len(funcs))])
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+_shard_settings = {}
+
+def get_shard_settings(settings):
+    """a settings dict per shard, each with its own SHARDS CONNECTION block.
+    We hand out the same dicts every time, so per settings helpers
+    (profilers, reconnect managers) are shared by every queryset.
+    The CACHE is left out, all shards share the one made from settings.
+    """
+    if id(settings) not in _shard_settings:
+        shard_settings = []
+        for connection in settings["SHARDS"]:
+            shard = dict(settings)
+            del shard["SHARDS"]
+            shard.pop("CACHE", None)
+            shard["CONNECTION"] = connection
+            shard_settings.append(shard)
+        # keep settings alive so its id is never reused
+        _shard_settings[id(settings)] = (settings, shard_settings)
+    return _shard_settings[id(settings)][1]
+
+def create_shard_pools(settings, pool_size=None, mode=None):
+    """create a connection pool for every shard, all shards at once"""
+    logging.debug("create_shard_pools")
+    if mode is None:
+        mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+    return run_parallel([
+        lambda shard=shard: create_db_conn_pool(shard, pool_size, mode)
+        for shard in get_shard_settings(settings)], mode)
+
+_shard_db_pools = {}
+
+def get_shard_db_pools(settings):
+    """the shard pools shared in this process, made once per settings"""
+    key = (os.getpid(), id(settings))
+    if key not in _shard_db_pools:
+        _shard_db_pools[key] = create_shard_pools(settings)
+    return _shard_db_pools[key]
+
+_bulk_settings = {}
+
+def get_bulk_settings(settings):
+    """settings for our bulk read connections, CONNECTION and POOL with
+    the BULK overrides applied. Like get_shard_settings we hand out the
+    same dict every time.
+    """
+    if id(settings) not in _bulk_settings:
+        bulk = dict(settings)
+        overrides = bulk.pop("BULK", {})
+        bulk["CONNECTION"] = dict(settings["CONNECTION"])
+        bulk["CONNECTION"].update(overrides.get("CONNECTION", {}))
+        bulk["POOL"] = dict(settings.get("POOL", {}))
+        bulk["POOL"].update(overrides.get("POOL", {}))
+        # keep settings alive so its id is never reused
+        _bulk_settings[id(settings)] = (settings, bulk)
+    return _bulk_settings[id(settings)][1]
+
+_bulk_db_pools = {}
+
+def get_bulk_db_pool(settings):
+    """the bulk read pool shared in this process, None without BULK settings"""
+    if "BULK" not in settings:
+        return None
+    key = (os.getpid(), id(settings))
+    if key not in _bulk_db_pools:
+        _bulk_db_pools[key] = create_db_conn_pool(get_bulk_settings(settings))
+    return _bulk_db_pools[key]
+
+_reconnect_managers = {}
+
+def get_reconnect_manager(settings):
+    """the ReconnectManager shared by connections without a DbPool
+    made from the same settings in this process
+    """
+    key = (os.getpid(), id(settings))
+    if key not in _reconnect_managers:
+        # keep settings alive so its id is never reused
+        _reconnect_managers[key] = (settings, ReconnectManager(settings))
+    return _reconnect_managers[key][1]
+
+
+# queued by DbPool._release to wake a caller waiting in get
+_FREE_SLOT = object()
+
+
+class DbPool(object):
+    """A fork-safe pool of MySQL connections.
+
+    Connections are created lazily, up to pool_size. The pool remembers the
+    pid it was built in; when used from a forked child it drops the parent's
+    connections (without closing them, the parent still owns those sockets)
+    and lazily builds its own.
+
+    MODE "gevent" keeps the connections in a gevent Queue.
+    MODE "thread" keeps them in a thread-safe LifoQueue so the most recently
+    used (warm) connection is handed out first.
+    """
+
+    def __init__(self, settings, pool_size=None, mode=None):
+        pool_settings = settings.get("POOL", {})
+        if pool_size is None:
+            pool_size = pool_settings.get("SIZE", 10)
+        if mode is None:
+            mode = pool_settings.get("MODE", POOL_MODE_GEVENT)
+        if mode not in (POOL_MODE_GEVENT, POOL_MODE_THREAD):
+            raise Exception("unknown POOL MODE: %s" % mode)
+        self.settings = settings
+        self.pool_size = pool_size
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """forget all our connections and start over in this process"""
+        self.pid = os.getpid()
+        self.created = 0
+        # callers blocked in get, and _FREE_SLOT markers queued for them
+        self.waiting = 0
+        self.free_slots = 0
+        self.reconnect = ReconnectManager(self.settings, self.mode)
+        if self.mode == POOL_MODE_THREAD:
+            self.queue = queue.LifoQueue()
+        else:
+            self.queue = gevent.queue.Queue()
+
+    def _check_pid(self):
+        """rebuild ourselves if we have been forked"""
+        if self.pid != os.getpid():
+            logging.debug("DbPool pid changed from %s to %s, rebuilding" %
+                          (self.pid, os.getpid()))
+            # a parent thread may have held the lock when we were forked
+            self._lock = threading.Lock()
+            self._reset()
+
+    def _reserve(self):
+        """reserve a slot for a new connection, False if we are full"""
+        with self._lock:
+            if self.created >= self.pool_size:
+                return False
+            self.created += 1
+            return True
+
+    def _reserve_or_wait(self):
+        """like _reserve, but if we are full count the caller as waiting
+        (under the same lock, so a _release can not slip in between)
+        """
+        with self._lock:
+            if self.created >= self.pool_size:
+                self.waiting += 1
+                return False
+            self.created += 1
+            return True
+
+    def _release(self):
+        """give back a slot reserved with _reserve and wake a waiter,
+        if one is not woken already, so it can connect in the freed slot
+        """
+        with self._lock:
+            self.created -= 1
+            wake = self.waiting > self.free_slots
+            if wake:
+                self.free_slots += 1
+        if wake:
+            self.queue.put_nowait(_FREE_SLOT)
+
+    def _is_free_slot(self, db_conn):
+        """True (and the marker is accounted for) if db_conn, taken
+        off our queue, is a _FREE_SLOT marker
+        """
+        if db_conn is not _FREE_SLOT:
+            return False
+        with self._lock:
+            self.free_slots -= 1
+        return True
+
+    def connect(self, limit=True):
+        """create a new connection, it takes an existing or reserved slot.
+        Goes through our ReconnectManager, so it may raise CircuitOpenException.
+        """
+        return self.reconnect.connect(limit)
+
+    def _add_conn(self):
+        """open a connection for a reserved slot and pool it"""
+        try:
+            # fill runs at FILL_CONCURRENCY, not the reconnect limit
+            self.queue.put_nowait(self.connect(limit=False))
         except Exception:
-            logging.debug("error creating db_conn")
+            self._release()
             raise
+        logging.debug("added db_conn to pool (%s created)" % self.created)
 
-    return db_pool
+    def _run_concurrently(self, func, count):
+        """call func count times, at most FILL_CONCURRENCY at once.
+        Under gevent this needs a monkey patched socket module to overlap.
+        """
+        concurrency = self.settings.get("POOL", {}).get("FILL_CONCURRENCY", 10)
+        errors = []
+        def run():
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+        while count > 0:
+            batch = min(count, max(concurrency, 1))
+            count -= batch
+            if self.mode == POOL_MODE_THREAD:
+                workers = [threading.Thread(target=run) for i in range(batch)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            else:
+                gevent.joinall([gevent.spawn(run) for i in range(batch)])
+        if len(errors) > 0:
+            raise errors[0]
+
+    def fill(self, count=None):
+        """open connections concurrently until we have count (default: all)"""
+        self._check_pid()
+        if count is None or count > self.pool_size:
+            count = self.pool_size
+        needed = 0
+        while self.created < count and self._reserve():
+            needed += 1
+        self._run_concurrently(self._add_conn, needed)
+
+    def fill_async(self, count=None):
+        """fill the pool in the background, errors are only logged"""
+        def run():
+            try:
+                self.fill(count)
+            except Exception:
+                logging.exception("DbPool error filling in the background")
+        return spawn(run, self.mode)
+
+    def get(self, block=True, timeout=None):
+        """get a connection, creating one if we have room.
+        Will block until one becomes available otherwise.
+        """
+        self._check_pid()
+        try:
+            db_conn = self.queue.get_nowait()
+            if not self._is_free_slot(db_conn):
+                return db_conn
+        except queue.Empty:
+            pass
+        while True:
+            if self._reserve_or_wait():
+                try:
+                    return self.connect()
+                except Exception:
+                    self._release()
+                    raise
+            # every slot is taken, wait for a connection or a freed slot
+            try:
+                db_conn = self.queue.get(block, timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not self._is_free_slot(db_conn):
+                return db_conn
+
+    def put(self, db_conn):
+        """return a connection to the pool"""
+        if db_conn is None:
+            return
+        self._check_pid()
+        if is_db_conn_inherited(db_conn):
+            # checked out before we were forked, it is not ours to reuse
+            logging.debug("DbPool dropping db_conn inherited from pid %s" %
+                          db_conn.creator_pid)
+            return
+        self.queue.put_nowait(db_conn)
+
+    put_nowait = put
+
+    def replace(self, db_conn):
+        """close a broken checked out connection and open a new one
+        in its slot, the slot is freed if we cannot connect
+        """
+        try:
+            db_conn.close()
+        except Exception:
+            pass
+        try:
+            return self.connect()
+        except Exception:
+            self._release()
+            raise
+
+    def discard(self, db_conn):
+        """drop a checked out connection and free its slot"""
+        if db_conn is not None and not is_db_conn_inherited(db_conn):
+            try:
+                db_conn.close()
+            except Exception:
+                pass
+            self._release()
+
+    def qsize(self):
+        """idle connections, not counting queued _FREE_SLOT markers"""
+        return max(self.queue.qsize() - self.free_slots, 0)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        """close all idle connections owned by this process"""
+        self._check_pid()
+        while True:
+            try:
+                db_conn = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if not self._is_free_slot(db_conn):
+                self.discard(db_conn)
+
+
+class RequestConnection(object):
+    """One connection shared by every queryset in a request.
+
+    Pass it as the db_conn of a queryset (or bind() one to it). The
+    connection is checked out of db_pool and pinged on first use only, and
+    goes back to the pool on release(). Querysets keep committing after
+    each write unless begin() opened a transaction, then commit() or
+    rollback() ends it and release() rolls back one left open.
+    Do not use it from parallel greenlets or threads, it is one connection.
+    """
+
+    def __init__(self, db_pool, settings=None):
+        self.db_pool = db_pool
+        self.settings = settings
+        self.db_conn = None
+        self.in_transaction = False
+        # (cache, table_tag, ids) waiting for the transaction to commit
+        self.pending_invalidations = []
+
+    def defer_invalidation(self, cache, table_tag, ids):
+        """hold a cache invalidation until commit()"""
+        self.pending_invalidations.append((cache, table_tag, ids))
+
+    def get(self):
+        """our connection, checked out on first use"""
+        if self.db_conn is None:
+            db_conn = self.db_pool.get()
+            try:
+                db_conn.ping()
+            except Exception:
+                logging.debug("RequestConnection error pinging, building new connection")
+                if isinstance(self.db_pool, DbPool):
+                    db_conn = self.db_pool.replace(db_conn)
+                elif self.settings is not None:
+                    db_conn = get_reconnect_manager(self.settings).connect()
+                else:
+                    raise
+            self.db_conn = db_conn
+        return self.db_conn
+
+    def begin(self):
+        """open a transaction, querysets stop committing until it ends"""
+        cursor = self.get().cursor()
+        try:
+            cursor.execute("BEGIN")
+        finally:
+            cursor.close()
+        self.in_transaction = True
+
+    def commit(self):
+        """commit, then publish the invalidations we held back.
+        Querysets evicted locally when they wrote, invalidate evicts
+        again in case another greenlet cached the old row since.
+        """
+        if self.db_conn is not None:
+            self.db_conn.commit()
+        self.in_transaction = False
+        pending = self.pending_invalidations
+        self.pending_invalidations = []
+        for (cache, table_tag, ids) in pending:
+            cache.invalidate(table_tag, ids)
+
+    def rollback(self):
+        """roll back, nothing changed so the held back invalidations
+        are dropped
+        """
+        try:
+            if self.db_conn is not None:
+                self.db_conn.rollback()
+        finally:
+            self.in_transaction = False
+            self.pending_invalidations = []
+
+    def release(self):
+        """give our connection back to the pool"""
+        if self.db_conn is None:
+            return
+        db_conn = self.db_conn
+        try:
+            if self.in_transaction:
+                logging.debug("RequestConnection rolling back unfinished transaction")
+                self.rollback()
+        finally:
+            self.db_conn = None
+            self.in_transaction = False
+            self.db_pool.put_nowait(db_conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import os
+import time
+import json
+import errno
+import socket
+import logging
+import threading
+from collections import OrderedDict
+
+import gevent
+import gevent.socket
+
+from base import POOL_MODE_GEVENT
+from base import POOL_MODE_THREAD
+from base import spawn
+
+##
+## An in-process cache for read_one and query results that stays correct
+## across worker processes. Every create_*, update_* and destroy_* publishes
+## (table_tag, ids) on an invalidation bus and every process evicts them.
+##
+## Here are the example settings, add them next to CONNECTION
+##
+"""
+    "CACHE": {
+        "ENABLED": True,                   ## Turn caching on
+        "MAX_ITEMS": 10000,                ## Items kept per process, least recently used go first
+        "TTL": 60,                         ## Seconds an item may live, None for no limit
+        "TRANSPORT": "unix",               ## "unix" (default), "zmq" or "local" (this process only)
+        "FLUSH_INTERVAL": 0.01,            ## Seconds we coalesce invalidations before publishing
+        "SOCKET_DIR": "/tmp/brubeckmysql", ## unix: every process binds a datagram socket here
+        "PUB_ADDRESS": "ipc:///tmp/brubeckmysql_pub", ## zmq: where publishers connect (forwarder XSUB)
+        "SUB_ADDRESS": "ipc:///tmp/brubeckmysql_sub", ## zmq: where subscribers connect (forwarder XPUB)
+    }
+"""
+
+# an ids value of None invalidates the whole table
+ALL_IDS = None
+
+# largest payload we send, it must fit the unix transport's recv
+MAX_PAYLOAD = 60000
+RECV_SIZE = 65536
+
+
+###
+### Transports move batches of invalidation messages between processes
+###
+
+class LocalTransport(object):
+    """delivers to this process only, for single process deployments"""
+
+    def __init__(self, settings):
+        self.callback = None
+
+    def start(self, callback):
+        self.callback = callback
+
+    def send(self, payload):
+        if self.callback is not None:
+            self.callback(payload)
+
+    def close(self):
+        self.callback = None
+
+
+class UnixSocketTransport(object):
+    """Every process binds a datagram socket in SOCKET_DIR, publishing
+    sends to all the sockets found there. Sockets of dead processes are
+    removed when sending to them fails.
+    Sending never blocks: a process whose queue is full (it is stuck or
+    slow to read) misses the message, we log it and count it in dropped.
+    """
+
+    def __init__(self, settings):
+        cache_settings = settings.get("CACHE", {})
+        self.socket_dir = cache_settings.get("SOCKET_DIR", "/tmp/brubeckmysql")
+        self.mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        self.path = os.path.join(self.socket_dir, "%s.sock" % os.getpid())
+        self.sock = None
+        self.listener = None
+        self.dropped = 0
+
+    def _socket(self):
+        if self.mode == POOL_MODE_THREAD:
+            return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        return gevent.socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def start(self, callback):
+        if not os.path.isdir(self.socket_dir):
+            os.makedirs(self.socket_dir)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = self._socket()
+        self.sock.bind(self.path)
+        def listen():
+            while self.sock is not None:
+                try:
+                    payload = self.sock.recv(RECV_SIZE)
+                except Exception:
+                    if self.sock is None:
+                        break
+                    logging.exception("UnixSocketTransport error receiving")
+                    continue
+                callback(payload)
+        self.listener = spawn(listen, self.mode)
+
+    def send(self, payload):
+        # a plain non-blocking socket, a gevent one would wait for room
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for name in os.listdir(self.socket_dir):
+                if not name.endswith(".sock"):
+                    continue
+                path = os.path.join(self.socket_dir, name)
+                try:
+                    sender.sendto(payload, socket.MSG_DONTWAIT, path)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.dropped += 1
+                        logging.warning("UnixSocketTransport dropped a message for %s, "
+                                        "its queue is full" % path)
+                    elif e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        # nobody is listening anymore
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    else:
+                        logging.exception("UnixSocketTransport error sending to %s" % path)
+        finally:
+            sender.close()
+
+    def close(self):
+        sock = self.sock
+        self.sock = None
+        if sock is not None:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class ZmqTransport(object):
+    """PUB/SUB over ZeroMQ. Many processes publish, so they connect to a
+    forwarder (see run_zmq_forwarder) instead of binding themselves.
+    """
+
+    def __init__(self, settings):
+        cache_settings = settings.get("CACHE", {})
+        self.mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        if self.mode == POOL_MODE_THREAD:
+            import zmq
+        else:
+            import zmq.green as zmq
+        self.zmq = zmq
+        self.context = zmq.Context()
+        self.pub_address = cache_settings.get("PUB_ADDRESS", "ipc:///tmp/brubeckmysql_pub")
+        self.sub_address = cache_settings.get("SUB_ADDRESS", "ipc:///tmp/brubeckmysql_sub")
+        self.pub = None
+        self.sub = None
+        self.listener = None
+        # zmq sockets are not thread safe
+        self._lock = threading.Lock()
+
+    def start(self, callback):
+        self.pub = self.context.socket(self.zmq.PUB)
+        self.pub.connect(self.pub_address)
+        self.sub = self.context.socket(self.zmq.SUB)
+        self.sub.setsockopt(self.zmq.SUBSCRIBE, b"")
+        self.sub.connect(self.sub_address)
+        def listen():
+            while self.sub is not None:
+                try:
+                    payload = self.sub.recv()
+                except Exception:
+                    if self.sub is None:
+                        break
+                    logging.exception("ZmqTransport error receiving")
+                    continue
+                callback(payload)
+        self.listener = spawn(listen, self.mode)
+
+    def send(self, payload):
+        with self._lock:
+            self.pub.send(payload)
+
+    def close(self):
+        pub, sub = self.pub, self.sub
+        self.pub = self.sub = None
+        for sock in (pub, sub):
+            if sock is not None:
+                sock.close(linger=0)
+
+
+def run_zmq_forwarder(settings):
+    """Run the XSUB/XPUB device ZmqTransport publishers and subscribers
+    meet at. Run it once per host, it blocks forever.
+    """
+    import zmq
+    cache_settings = settings.get("CACHE", {})
+    context = zmq.Context()
+    xsub = context.socket(zmq.XSUB)
+    xsub.bind(cache_settings.get("PUB_ADDRESS", "ipc:///tmp/brubeckmysql_pub"))
+    xpub = context.socket(zmq.XPUB)
+    xpub.bind(cache_settings.get("SUB_ADDRESS", "ipc:///tmp/brubeckmysql_sub"))
+    zmq.proxy(xsub, xpub)
+
+TRANSPORTS = {
+    "local": LocalTransport,
+    "unix": UnixSocketTransport,
+    "zmq": ZmqTransport,
+}
+
+
+###
+### The bus coalesces invalidations and hands them to the transport
+###
+
+class InvalidationBus(object):
+    """Publishes (table_tag, ids) invalidations and delivers the ones
+    received to our subscribers. Invalidations published within
+    FLUSH_INTERVAL are merged into a single message.
+    """
+
+    def __init__(self, settings, transport=None):
+        cache_settings = settings.get("CACHE", {})
+        self.mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        self.flush_interval = cache_settings.get("FLUSH_INTERVAL", 0.01)
+        if transport is None:
+            # default to a transport that reaches every process,
+            # "local" has to be asked for
+            transport_name = cache_settings.get("TRANSPORT", "unix")
+            if transport_name not in TRANSPORTS:
+                raise Exception("unknown CACHE TRANSPORT: %s" % transport_name)
+            transport = TRANSPORTS[transport_name](settings)
+        self.transport = transport
+        self.subscribers = []
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+        self.transport.start(self._receive)
+
+    def subscribe(self, callback):
+        """callback(table_tag, ids) is called for every invalidation"""
+        self.subscribers.append(callback)
+
+    def publish(self, table_tag, ids=ALL_IDS):
+        """queue an invalidation, it is sent with the next batch"""
+        with self._lock:
+            if ids is ALL_IDS or self._pending.get(table_tag, []) is ALL_IDS:
+                self._pending[table_tag] = ALL_IDS
+            else:
+                self._pending.setdefault(table_tag, set()).update(ids)
+            if self._flusher is None:
+                self._flusher = spawn(self._flush_later, self.mode)
+
+    def _flush_later(self):
+        if self.mode == POOL_MODE_THREAD:
+            time.sleep(self.flush_interval)
+        else:
+            gevent.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """send everything pending now"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._flusher = None
+        if len(pending) == 0:
+            return
+        for payload in self._payloads(pending):
+            try:
+                self.transport.send(payload)
+            except Exception:
+                logging.exception("InvalidationBus error publishing")
+
+    def _payloads(self, pending):
+        """encode pending invalidations as payloads of at most MAX_PAYLOAD
+        bytes. A table with too many ids to fit is invalidated as a whole.
+        """
+        entries = []
+        for table_tag, ids in pending.items():
+            entry = json.dumps([table_tag, None if ids is ALL_IDS else list(ids)])
+            if len(entry) > MAX_PAYLOAD:
+                entry = json.dumps([table_tag, None])
+            entries.append(entry)
+        payloads = []
+        batch = []
+        size = 2
+        for entry in entries:
+            if len(batch) > 0 and size + len(entry) + 1 > MAX_PAYLOAD:
+                payloads.append(batch)
+                batch = []
+                size = 2
+            batch.append(entry)
+            size += len(entry) + 1
+        payloads.append(batch)
+        return [("[%s]" % ",".join(batch)).encode("utf8") for batch in payloads]
+
+    def _receive(self, payload):
+        try:
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf8")
+            messages = json.loads(payload)
+        except Exception:
+            logging.exception("InvalidationBus got a bad message")
+            return
+        for table_tag, ids in messages:
+            for callback in self.subscribers:
+                try:
+                    callback(table_tag, ids)
+                except Exception:
+                    logging.exception("InvalidationBus subscriber error")
+
+    def close(self):
+        self.flush()
+        self.transport.close()
+
+
+###
+### The cache itself
+###
+
+def copy_value(value):
+    """copy the rows (dicts, lists and tuples of them) we cache, so a
+    caller changing its result does not change it for everyone else
+    """
+    if isinstance(value, dict):
+        return dict((key, copy_value(val)) for (key, val) in value.items())
+    if isinstance(value, list):
+        return [copy_value(val) for val in value]
+    if isinstance(value, tuple):
+        return tuple(copy_value(val) for val in value)
+    return value
+
+
+class QueryCache(object):
+    """A process local LRU cache of read_one items (by table_tag and id)
+    and query results (by table_tag and sql), evicted by the bus.
+    Values are copied going in and coming out.
+    """
+
+    def __init__(self, settings, bus=None):
+        cache_settings = settings.get("CACHE", {})
+        self.max_items = cache_settings.get("MAX_ITEMS", 10000)
+        self.ttl = cache_settings.get("TTL", 60)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        # keys of the cached query results for each table_tag
+        self._queries = {}
+        self.hits = 0
+        self.misses = 0
+        if bus is None:
+            bus = InvalidationBus(settings)
+        self.bus = bus
+        self.bus.subscribe(self.evict)
+
+    def get(self, key):
+        """a copy of the value cached for key, or None"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                self._drop(key)
+                self.misses += 1
+                return None
+            # most recently used go last
+            del self._items[key]
+            self._items[key] = entry
+            self.hits += 1
+        return copy_value(value)
+
+    def set(self, key, value):
+        value = copy_value(value)
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+            self._items[key] = (value, expires)
+            if key[0] == "query":
+                self._queries.setdefault(key[1], set()).add(key)
+            while len(self._items) > self.max_items:
+                # the least recently used is first
+                self._drop(next(iter(self._items)))
+
+    def _drop(self, key):
+        """remove key from our items and query tracking, hold _lock"""
+        self._items.pop(key, None)
+        if key[0] == "query":
+            keys = self._queries.get(key[1])
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._queries[key[1]]
+
+    def item_key(self, table_tag, iid):
+        return ("item", table_tag, iid)
+
+    def query_key(self, table_tag, sql):
+        return ("query", table_tag, sql)
+
+    def evict(self, table_tag, ids=ALL_IDS):
+        """drop the items for ids (all of them if ids is None) and every
+        query result for table_tag
+        """
+        with self._lock:
+            for key in self._queries.pop(table_tag, ()):
+                self._items.pop(key, None)
+            if ids is ALL_IDS:
+                for key in [key for key in self._items if key[1] == table_tag]:
+                    self._drop(key)
+            else:
+                for iid in ids:
+                    self._items.pop(self.item_key(table_tag, iid), None)
+
+    def invalidate(self, table_tag, ids=ALL_IDS):
+        """evict locally right away and tell every other process"""
+        self.evict(table_tag, ids)
+        self.bus.publish(table_tag, ids)
+
+    def clear(self):
+        with self._lock:
+            self._items = OrderedDict()
+            self._queries = {}
+
+
+_caches = {}
+
+def get_cache(settings):
+    """the QueryCache shared by querysets made from the same settings in
+    this process, None unless CACHE ENABLED is set
+    """
+    if not settings.get("CACHE", {}).get("ENABLED", False):
+        return None
+    key = (os.getpid(), id(settings))
+    if key not in _caches:
+        # keep settings alive so its id is never reused
+        _caches[key] = (settings, QueryCache(settings))
+    return _caches[key][1]
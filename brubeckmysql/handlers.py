@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+from base import RequestConnection
+
+##
+## Request scoped connections for Brubeck handlers.
+##
+## class UserHandler(MySqlRequestMixin, JSONMessageHandler):
+##     def get(self, iid):
+##         users = UserQueryset(settings, self.request_conn, 'users')
+##         groups = GroupQueryset(settings, self.request_conn, 'groups')
+##         ...
+##
+## Both querysets share one connection, checked out on first use and
+## returned to the pool when the handler finishes.
+##
+
+
+class MySqlRequestMixin(object):
+    """Handler mixin giving each request one lazily checked out connection.
+    Our pool is the handler's db_conn (the application's), override
+    get_request_db_pool to use another one.
+    """
+
+    _request_conn = None
+
+    def get_request_db_pool(self):
+        return self.db_conn
+
+    @property
+    def request_conn(self):
+        """the RequestConnection for this request, pass it as db_conn"""
+        if self._request_conn is None:
+            self._request_conn = RequestConnection(self.get_request_db_pool())
+        return self._request_conn
+
+    def bind_queryset(self, queryset):
+        """share our request connection with a queryset built elsewhere"""
+        queryset.bind(self.request_conn)
+        return queryset
+
+    def release_request_conn(self):
+        """return our connection to the pool, rolling back an open transaction"""
+        if self._request_conn is not None:
+            try:
+                self._request_conn.release()
+            finally:
+                self._request_conn = None
+
+    def on_finish(self):
+        self.release_request_conn()
+        parent = super(MySqlRequestMixin, self)
+        if hasattr(parent, 'on_finish'):
+            parent.on_finish()
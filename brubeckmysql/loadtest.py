@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import imp
+import copy
+import time
+import random
+import socket
+import threading
+import logging
+import argparse
+
+import gevent
+import gevent.socket
+
+from base import DbPool
+from base import spawn
+from base import POOL_MODE_GEVENT
+from base import POOL_MODE_THREAD
+from querysets import MySqlApiQueryset
+
+##
+## A load test for sizing pools before we deploy.
+## N greenlets (or threads) run a weighted mix of read_one, create_one and
+## query against a local MySQL, optionally through a FaultProxy adding
+## latency and dropping connections, and we report throughput, latency
+## percentiles, pool wait time, connect time, reconnects and errors per second.
+##
+## python -m brubeckmysql.loadtest settings.py users --workers 50 --pool-size 10
+##   --mix read_one=8,query=2 --duration 30 --latency 0.002 --drop-rate 0.001
+##
+## settings.py defines the usual mysql dict (see base.py).
+##
+
+OPERATIONS = ("read_one", "create_one", "query")
+
+
+def percentile(values, fraction):
+    """the value below which fraction of the sorted values fall"""
+    if len(values) == 0:
+        return None
+    index = min(int(len(values) * fraction), len(values) - 1)
+    return values[index]
+
+
+class TimedDbPool(DbPool):
+    """a DbPool that records how long callers wait for a connection,
+    and separately how long opening new connections takes
+    """
+
+    def __init__(self, settings, pool_size=None, mode=None):
+        self.waits = []
+        self.connects = []
+        # time spent connecting by each caller inside get
+        self._connecting = {}
+        super(TimedDbPool, self).__init__(settings, pool_size, mode)
+
+    def _caller(self):
+        if self.mode == POOL_MODE_THREAD:
+            return threading.current_thread()
+        return gevent.getcurrent()
+
+    def connect(self, limit=True):
+        started = time.time()
+        try:
+            return super(TimedDbPool, self).connect(limit)
+        finally:
+            elapsed = time.time() - started
+            # list.append is atomic, no lock needed
+            self.connects.append(elapsed)
+            caller = self._caller()
+            if caller in self._connecting:
+                self._connecting[caller] += elapsed
+
+    def get(self, block=True, timeout=None):
+        caller = self._caller()
+        self._connecting[caller] = 0.0
+        started = time.time()
+        try:
+            return super(TimedDbPool, self).get(block, timeout)
+        finally:
+            # connecting in a free slot is not waiting for the pool
+            connecting = self._connecting.pop(caller, 0.0)
+            self.waits.append(time.time() - started - connecting)
+
+
+class FaultProxy(object):
+    """A TCP stand-in between us and MySQL. Every chunk sent to the server
+    is delayed by latency seconds, and with drop_rate probability the
+    connection is cut instead, like a flaky network or a failover.
+    """
+
+    def __init__(self, settings, latency=0.0, drop_rate=0.0, mode=POOL_MODE_GEVENT):
+        self.settings = settings
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.mode = mode
+        self.listener = None
+        self.port = None
+        self.connections = 0
+        self.drops = 0
+
+    def _socket(self, *args):
+        if self.mode == POOL_MODE_THREAD:
+            return socket.socket(*args)
+        return gevent.socket.socket(*args)
+
+    def _sleep(self, seconds):
+        if self.mode == POOL_MODE_THREAD:
+            time.sleep(seconds)
+        else:
+            gevent.sleep(seconds)
+
+    def start(self):
+        self.listener = self._socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        spawn(self._accept, self.mode)
+        logging.debug("FaultProxy listening on %s" % self.port)
+
+    def stop(self):
+        listener = self.listener
+        self.listener = None
+        if listener is not None:
+            listener.close()
+
+    def proxied_settings(self):
+        """a copy of settings connecting through us"""
+        settings = copy.deepcopy(self.settings)
+        settings["CONNECTION"]["HOST"] = "127.0.0.1"
+        settings["CONNECTION"]["PORT"] = self.port
+        return settings
+
+    def _accept(self):
+        while self.listener is not None:
+            try:
+                client = self.listener.accept()[0]
+            except Exception:
+                if self.listener is None:
+                    break
+                logging.exception("FaultProxy error accepting")
+                continue
+            self.connections += 1
+            server = self._socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                server.connect((self.settings["CONNECTION"]["HOST"],
+                                self.settings["CONNECTION"]["PORT"]))
+            except Exception:
+                client.close()
+                continue
+            spawn(self._pipe, self.mode, client, server, True)
+            spawn(self._pipe, self.mode, server, client, False)
+
+    def _pipe(self, source, destination, to_server):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if to_server:
+                    if self.drop_rate > 0 and random.random() < self.drop_rate:
+                        self.drops += 1
+                        break
+                    if self.latency > 0:
+                        self._sleep(self.latency)
+                destination.sendall(data)
+        except Exception:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+
+
+class LoadTest(object):
+    """runs the workers and collects what they see"""
+
+    def __init__(self, settings, table_tag, workers=10, duration=10.0, mix=None,
+                 pool_size=None, mode=None, id_range=(1, 1000), sql=None,
+                 make_shield=None, latency=0.0, drop_rate=0.0):
+        if mode is None:
+            mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        if mix is None:
+            mix = {"read_one": 1}
+        for operation in mix:
+            if operation not in OPERATIONS:
+                raise Exception("unknown operation in mix: %s" % operation)
+        if mix.get("create_one") and make_shield is None:
+            raise Exception("create_one in mix needs make_shield")
+        self.settings = settings
+        self.table_tag = table_tag
+        self.workers = workers
+        self.duration = duration
+        self.mix = mix
+        self.pool_size = pool_size
+        self.mode = mode
+        self.id_range = id_range
+        self.sql = sql
+        self.make_shield = make_shield
+        self.proxy = None
+        if latency > 0 or drop_rate > 0:
+            self.proxy = FaultProxy(settings, latency, drop_rate, mode)
+        self.samples = []   # (operation, started, elapsed, error)
+        self.started = None
+
+    def _choose(self):
+        total = sum(self.mix.values())
+        pick = random.uniform(0, total)
+        for operation, weight in self.mix.items():
+            pick -= weight
+            if pick <= 0:
+                return operation
+        return operation
+
+    def _run_operation(self, queryset, operation):
+        if operation == "read_one":
+            return queryset.read_one(random.randint(*self.id_range))
+        if operation == "create_one":
+            return queryset.create_one(self.make_shield())
+        sql = self.sql
+        if sql is None:
+            sql = u"SELECT count(*) FROM `%s`" % queryset.table_name
+        return queryset.query(sql)
+
+    def _worker(self, queryset, deadline):
+        while time.time() < deadline:
+            operation = self._choose()
+            started = time.time()
+            error = None
+            try:
+                self._run_operation(queryset, operation)
+            except Exception as e:
+                error = e.__class__.__name__
+            self.samples.append((operation, started, time.time() - started, error))
+
+    def run(self):
+        settings = self.settings
+        if self.proxy is not None:
+            self.proxy.start()
+            settings = self.proxy.proxied_settings()
+        self.db_pool = TimedDbPool(settings, self.pool_size, self.mode)
+        try:
+            self.started = time.time()
+            deadline = self.started + self.duration
+            workers = [spawn(self._worker, self.mode,
+                             MySqlApiQueryset(settings, self.db_pool, self.table_tag),
+                             deadline)
+                       for i in range(self.workers)]
+            if self.mode == POOL_MODE_THREAD:
+                for worker in workers:
+                    worker.join()
+            else:
+                gevent.joinall(workers)
+        finally:
+            self.db_pool.close()
+            if self.proxy is not None:
+                self.proxy.stop()
+        return self.report()
+
+    def report(self):
+        """summarize the samples, overall, per operation and per second"""
+        elapsed = max(time.time() - self.started, 0.001)
+        def summarize(samples):
+            latencies = sorted([sample[2] for sample in samples])
+            errors = {}
+            for sample in samples:
+                if sample[3] is not None:
+                    errors[sample[3]] = errors.get(sample[3], 0) + 1
+            return {
+                "count": len(samples),
+                "errors": sum(errors.values()),
+                "error_types": errors,
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+            }
+        report = summarize(self.samples)
+        report["throughput"] = report["count"] / elapsed
+        report["operations"] = dict(
+            (operation, summarize([s for s in self.samples if s[0] == operation]))
+            for operation in self.mix)
+        intervals = {}
+        for sample in self.samples:
+            intervals.setdefault(int(sample[1] - self.started), []).append(sample)
+        report["intervals"] = []
+        for second in sorted(intervals.keys()):
+            interval = summarize(intervals[second])
+            interval["second"] = second
+            report["intervals"].append(interval)
+        waits = sorted(self.db_pool.waits)
+        connects = sorted(self.db_pool.connects)
+        report["pool"] = {
+            "size": self.db_pool.pool_size,
+            "mode": self.mode,
+            "created": self.db_pool.created,
+            "wait_total": sum(waits),
+            "wait_p50": percentile(waits, 0.50),
+            "wait_p99": percentile(waits, 0.99),
+            "connects": len(connects),
+            "connect_p50": percentile(connects, 0.50),
+            "connect_p99": percentile(connects, 0.99),
+        }
+        report["reconnect"] = self.db_pool.reconnect.stats()
+        if self.proxy is not None:
+            report["proxy"] = {"connections": self.proxy.connections,
+                               "drops": self.proxy.drops}
+        return report
+
+
+def run_load_test(settings, table_tag, **kw):
+    """run a LoadTest and return its report"""
+    return LoadTest(settings, table_tag, **kw).run()
+
+
+def format_report(report):
+    """a plain text table of a LoadTest report"""
+    def ms(seconds):
+        if seconds is None:
+            return "-"
+        return "%.2fms" % (seconds * 1000)
+    lines = [
+        "throughput: %.1f ops/s, %s ops, %s errors" %
+            (report["throughput"], report["count"], report["errors"]),
+        "latency: p50 %s, p99 %s" % (ms(report["p50"]), ms(report["p99"])),
+    ]
+    for operation, stats in sorted(report["operations"].items()):
+        lines.append("  %-10s %8s ops  p50 %10s  p99 %10s  errors %s" %
+                     (operation, stats["count"], ms(stats["p50"]),
+                      ms(stats["p99"]), stats["errors"]))
+    pool = report["pool"]
+    lines.append("pool (%s, size %s, created %s): wait p50 %s, p99 %s, total %.2fs" %
+                 (pool["mode"], pool["size"], pool["created"], ms(pool["wait_p50"]),
+                  ms(pool["wait_p99"]), pool["wait_total"]))
+    lines.append("connects: %s, p50 %s, p99 %s" %
+                 (pool["connects"], ms(pool["connect_p50"]), ms(pool["connect_p99"])))
+    reconnect = report["reconnect"]
+    lines.append("reconnects: %s attempts, %s failures, %s rejected, circuit %s" %
+                 (reconnect["attempts"], reconnect["failures"],
+                  reconnect["rejected"], reconnect["state"]))
+    if "proxy" in report:
+        lines.append("proxy: %s connections, %s dropped" %
+                     (report["proxy"]["connections"], report["proxy"]["drops"]))
+    lines.append("second      ops  errors        p50        p99")
+    for interval in report["intervals"]:
+        lines.append("%6s %8s %7s %10s %10s" %
+                     (interval["second"], interval["count"], interval["errors"],
+                      ms(interval["p50"]), ms(interval["p99"])))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a BrubeckMySQL pool")
+    parser.add_argument("settings", help="python file defining a mysql settings dict")
+    parser.add_argument("table_tag", help="the TABLES entry to run against")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--mix", default="read_one=1",
+                        help="weighted operations, e.g. read_one=8,query=1,create_one=1")
+    parser.add_argument("--pool-size", type=int, default=None)
+    parser.add_argument("--mode", choices=(POOL_MODE_GEVENT, POOL_MODE_THREAD), default=None)
+    parser.add_argument("--id-min", type=int, default=1)
+    parser.add_argument("--id-max", type=int, default=1000)
+    parser.add_argument("--sql", default=None, help="the statement query runs")
+    parser.add_argument("--shield-factory", default=None,
+                        help="module:function returning a new shield for create_one")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the proxy adds to every request")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="chance the proxy drops a connection on a request")
+    args = parser.parse_args()
+
+    settings = imp.load_source("loadtest_settings", args.settings).mysql
+    mode = args.mode or settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+    if mode == POOL_MODE_GEVENT:
+        # pymysql needs cooperative sockets for greenlets to overlap
+        from gevent import monkey
+        monkey.patch_socket()
+    mix = {}
+    for item in args.mix.split(","):
+        operation, weight = item.split("=")
+        mix[operation.strip()] = float(weight)
+    make_shield = None
+    if args.shield_factory is not None:
+        module_name, function_name = args.shield_factory.split(":")
+        make_shield = getattr(__import__(module_name, fromlist=[function_name]),
+                              function_name)
+    report = run_load_test(settings, args.table_tag, workers=args.workers,
+                           duration=args.duration, mix=mix, pool_size=args.pool_size,
+                           mode=mode, id_range=(args.id_min, args.id_max), sql=args.sql,
+                           make_shield=make_shield, latency=args.latency,
+                           drop_rate=args.drop_rate)
+    print(format_report(report))
+
+if __name__ == "__main__":
+    main()
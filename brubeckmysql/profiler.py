@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import os
+import re
+import random
+import logging
+import threading
+
+import gevent.lock
+from pymysql import cursors
+
+from base import create_db_conn
+from base import is_db_conn_inherited
+from base import spawn
+from base import POOL_MODE_GEVENT
+from base import POOL_MODE_THREAD
+
+##
+## An optional profiler for MySqlQueryset.query.
+## Slow (or sampled) SELECTs are EXPLAINed on a side connection and the
+## plans are aggregated by SQL fingerprint and table_tag, so full table
+## scans and filesorts show up in staging before they hurt production.
+##
+## Here are the example settings, add them next to CONNECTION
+##
+"""
+    "PROFILER": {
+        "ENABLED": True,                   ## Turn the profiler on
+        "THRESHOLD": 0.1,                  ## Seconds, EXPLAIN every query slower than this
+        "SAMPLE_RATE": 0.01,               ## Fraction of the other queries to EXPLAIN as well
+    }
+"""
+
+# precompiled patterns used to fingerprint sql
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint_sql(sql):
+    """reduce sql to its shape: literals become ?, IN lists collapse,
+    whitespace and case are normalized
+    """
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("in (?+)", sql)
+    sql = _SPACE_RE.sub(" ", sql)
+    return sql.strip().lower()
+
+
+class QueryProfiler(object):
+    """EXPLAINs slow or sampled queries and aggregates what it finds"""
+
+    def __init__(self, settings):
+        profiler_settings = settings.get("PROFILER", {})
+        self.settings = settings
+        self.threshold = profiler_settings.get("THRESHOLD", 0.1)
+        self.sample_rate = profiler_settings.get("SAMPLE_RATE", 0.0)
+        self.mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        self._lock = threading.Lock()
+        if self.mode == POOL_MODE_THREAD:
+            self._conn_lock = threading.Lock()
+        else:
+            self._conn_lock = gevent.lock.Semaphore()
+        self.db_conn = None
+        self.stats = {}
+
+    def should_explain(self, sql, elapsed):
+        if not sql.lstrip()[:6].lower() == "select":
+            return False
+        if elapsed >= self.threshold:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def get_db_conn(self):
+        """our side connection, never one from the queryset's pool"""
+        if self.db_conn is None or is_db_conn_inherited(self.db_conn):
+            self.db_conn = create_db_conn(self.settings)
+        return self.db_conn
+
+    def explain(self, sql):
+        """run EXPLAIN for sql, returns the plan rows as dicts"""
+        with self._conn_lock:
+            return self._explain(sql)
+
+    def _explain(self, sql):
+        """EXPLAIN on the side connection, the caller holds _conn_lock"""
+        cursor = None
+        try:
+            db_conn = self.get_db_conn()
+            db_conn.ping()
+            cursor = db_conn.cursor(cursors.DictCursor)
+            cursor.execute("EXPLAIN %s" % sql)
+            return cursor.fetchall()
+        except Exception:
+            # drop the side connection, we will make a new one next time
+            self.db_conn = None
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def observe(self, table_tag, sql, elapsed):
+        """record a query run by MySqlQueryset.query, EXPLAINing it if needed.
+        The EXPLAIN runs in the background and is skipped while the side
+        connection is busy, so the query we watch never waits on it.
+        Never raises, the profiler must not break the query it watches.
+        """
+        try:
+            fingerprint = fingerprint_sql(sql)
+            self.record(table_tag, fingerprint, sql, elapsed)
+            if self.should_explain(sql, elapsed):
+                if self._conn_lock.acquire(False):
+                    spawn(self._explain_in_background, self.mode,
+                          table_tag, fingerprint, sql)
+                else:
+                    self.record_skipped(table_tag, fingerprint)
+        except Exception:
+            logging.exception("QueryProfiler error observing query")
+
+    def _explain_in_background(self, table_tag, fingerprint, sql):
+        """runs with _conn_lock already acquired by observe, releases it"""
+        try:
+            self.record_plan(table_tag, fingerprint, sql, self._explain(sql))
+        except Exception:
+            logging.exception("QueryProfiler error explaining query")
+        finally:
+            self._conn_lock.release()
+
+    def _get_stat(self, table_tag, fingerprint):
+        """the stats entry for a query, the caller holds _lock"""
+        key = (fingerprint, table_tag)
+        if key not in self.stats:
+            self.stats[key] = {
+                "fingerprint": fingerprint,
+                "table_tag": table_tag,
+                "count": 0,
+                "total_time": 0.0,
+                "max_time": 0.0,
+                "explained": 0,
+                "explain_skipped": 0,
+                "full_scans": 0,
+                "filesorts": 0,
+                "max_rows": 0,
+                "plan": None,
+                "sample_sql": None,
+            }
+        return self.stats[key]
+
+    def record(self, table_tag, fingerprint, sql, elapsed, plan=None):
+        """aggregate one query (and its plan if we have one)"""
+        with self._lock:
+            stat = self._get_stat(table_tag, fingerprint)
+            stat["count"] += 1
+            stat["total_time"] += elapsed
+            stat["max_time"] = max(stat["max_time"], elapsed)
+        if plan is not None:
+            self.record_plan(table_tag, fingerprint, sql, plan)
+
+    def record_plan(self, table_tag, fingerprint, sql, plan):
+        """aggregate the EXPLAIN plan of a query already counted by record"""
+        full_scans = []
+        filesort = False
+        for row in plan:
+            if row.get("type") == "ALL":
+                full_scans.append(row.get("table"))
+            if "filesort" in (row.get("Extra") or ""):
+                filesort = True
+        with self._lock:
+            stat = self._get_stat(table_tag, fingerprint)
+            stat["explained"] += 1
+            if len(full_scans) > 0:
+                stat["full_scans"] += 1
+            if filesort:
+                stat["filesorts"] += 1
+            rows = sum([int(row.get("rows") or 0) for row in plan])
+            stat["max_rows"] = max(stat["max_rows"], rows)
+            stat["plan"] = [dict(table=row.get("table"), type=row.get("type"),
+                                 key=row.get("key"), rows=row.get("rows"),
+                                 extra=row.get("Extra"))
+                            for row in plan]
+            stat["sample_sql"] = sql
+
+    def record_skipped(self, table_tag, fingerprint):
+        """count an EXPLAIN we dropped because the side connection was busy"""
+        with self._lock:
+            self._get_stat(table_tag, fingerprint)["explain_skipped"] += 1
+
+    def report(self, flagged_only=False):
+        """aggregated stats, slowest total time first.
+        flagged_only limits us to queries seen doing full scans or filesorts.
+        """
+        with self._lock:
+            stats = [dict(stat) for stat in self.stats.values()]
+        if flagged_only:
+            stats = [stat for stat in stats
+                     if stat["full_scans"] > 0 or stat["filesorts"] > 0]
+        stats.sort(key=lambda stat: stat["total_time"], reverse=True)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+_profilers = {}
+
+def get_profiler(settings):
+    """the QueryProfiler shared by querysets made from the same settings in
+    this process, None unless PROFILER ENABLED is set
+    """
+    if not settings.get("PROFILER", {}).get("ENABLED", False):
+        return None
+    key = (os.getpid(), id(settings))
+    if key not in _profilers:
+        # keep settings alive so its id is never reused
+        _profilers[key] = (settings, QueryProfiler(settings))
+    return _profilers[key][1]
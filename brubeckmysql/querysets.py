@@ -18,10 +18,50 @@ from schematics.types import compound as CompoundFields
 from schematics.types import mongo as MongoFields
 from base import create_db_conn_pool
 from base import create_db_conn
+from base import is_db_conn_inherited
+from base import DbPool
+from base import RequestConnection
+from base import get_reconnect_manager
+from base import get_bulk_db_pool
+from base import get_shard_settings
+from base import get_shard_db_pools
+from base import run_parallel
+from base import POOL_MODE_GEVENT
+from profiler import get_profiler
+from cache import get_cache
 import schematics
 from gevent.queue import Queue
 
 import re, htmlentitydefs
+import bisect
+import heapq
+
+# compiled once, not on every call
+_ENTITY_RE = re.compile(r"&#?\w+;")
+# every named entity we know, the numeric ones are added as we meet them
+_ENTITY_CACHE = dict(("&%s;" % name, unichr(codepoint))
+                     for (name, codepoint) in htmlentitydefs.name2codepoint.items())
+_ENTITY_CACHE_MAX = 10000
+
+def _fixup_entity(m):
+    text = m.group(0)
+    try:
+        return _ENTITY_CACHE[text]
+    except KeyError:
+        pass
+    if text[:2] == "&#":
+        # character reference
+        try:
+            if text[:3] == "&#x":
+                char = unichr(int(text[3:-1], 16))
+            else:
+                char = unichr(int(text[2:-1]))
+        except (ValueError, OverflowError):
+            return text # leave as is
+        if len(_ENTITY_CACHE) < _ENTITY_CACHE_MAX:
+            _ENTITY_CACHE[text] = char
+        return char
+    return text # unknown named entity, leave as is
 
 ##
 # Removes HTML or XML character references and entities from a text string.
@@ -29,28 +69,34 @@ import re, htmlentitydefs
 # @param text The HTML (or XML) source text.
 # @return The plain text, as a Unicode string, if necessary.
 
-
 def unescape(text):
     """Thanks http://effbot.org/zone/re-sub.htm#unescape-html"""
-    def fixup(m):
-        text = m.group(0)
-        if text[:2] == "&#":
-            # character reference
-            try:
-                if text[:3] == "&#x":
-                    return unichr(int(text[3:-1], 16))
-                else:
-                    return unichr(int(text[2:-1]))
-            except ValueError:
-                pass
-        else:
-            # named entity
-            try:
-                text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-            except KeyError:
-                pass
-        return text # leave as is
-    return re.sub("&#?\w+;", fixup, text)
+    # most values have nothing to unescape, skip the regex for them
+    if not text or "&" not in text:
+        return text
+    return _ENTITY_RE.sub(_fixup_entity, text)
+
+def unescape_column(values):
+    """unescape a whole column of values at once"""
+    return [unescape(value) for value in values]
+
+def _decode_epoch(value):
+    """the inverse of how escape_sql writes datetimes"""
+    return datetime.datetime.fromtimestamp(float(value))
+
+##
+# Decoders a TABLES FIELDS entry can name in "decode", e.g.
+#   {"name": "title", "decode": "unescape"}
+#   {"name": "created", "read_format": "UNIX_TIMESTAMP(%s)", "decode": "epoch"}
+# Each takes a list of the column's values (never None) and returns a list.
+# A FIELDS entry can also give its own callable.
+DECODERS = {
+    "unescape": unescape_column,
+    "json": lambda values: [json.loads(value) for value in values],
+    "int": lambda values: [int(value) for value in values],
+    "float": lambda values: [float(value) for value in values],
+    "epoch": lambda values: [_decode_epoch(value) for value in values],
+}
 
 ###
 ### All of our data interaction with any data store happens in a Queryset object
@@ -76,10 +122,26 @@ class MySqlQueryset(object):
         logging.debug("MySqlQueryset __init__ db_conn=%s (%s)" %
                       (db_conn, db_conn.__class__ if not db_conn is None else 'None'))
         self.settings = settings
+        self.table_tag = table_tag
+        # an optional QueryProfiler, see PROFILER in profiler.py
+        self.profiler = get_profiler(settings)
+        # an optional QueryCache, see CACHE in cache.py
+        self.cache = get_cache(settings)
         if auto_commit is None:
             auto_commit = True
         self.auto_commit = auto_commit
-        if isinstance(db_conn, Queue):
+        # a separate pool of connections tuned for bulk reads
+        self.bulk_pool = None
+        self.bulk = False
+        # the connection shared by a whole request, if we are bound to one
+        self.request_conn = None
+        # (cache, table_tag, ids) waiting for our commit
+        self.pending_invalidations = []
+        if isinstance(db_conn, RequestConnection):
+            self.request_conn = db_conn
+            self.db_pool = db_conn.db_pool
+            self.db_conn = None
+        elif isinstance(db_conn, (Queue, DbPool)):
             self.db_pool = db_conn
             self.db_conn = None
         else:
@@ -93,6 +155,8 @@ class MySqlQueryset(object):
         # Once Schematic has more meta data, this may not be necessary anymore
         self.table_name = None          # the name of the database table
         self.fields = None              # A list of field names
+        self._decoders = []             # (column, decoder) built from fields
+        self._decoders_fields = None    # the fields _decoders were built from
         if table_tag is None:
             # We will need to set these in the entity specific implementation
             # Once Schematic has more meta data, this may not be necessary anymore
@@ -108,20 +172,89 @@ class MySqlQueryset(object):
                       (self.table_name, self.fields, self.fields_muteable))
 
     def set_db_pool(self, db_pool):
-        """set our db_pool (gevent.queue.Queue)"""
+        """set our db_pool (DbPool or gevent.queue.Queue)"""
         self.db_pool = db_pool
 
     def set_db_conn(self, db_conn):
         """set our db_conn"""
         self.db_conn = db_conn
 
+    def set_profiler(self, profiler):
+        """set our QueryProfiler, None turns profiling off"""
+        self.profiler = profiler
+
+    def set_cache(self, cache):
+        """set our QueryCache, None turns caching off"""
+        self.cache = cache
+
+    def invalidate(self, ids=None, commit=True):
+        """Evict cached results for our table_tag in every process.
+        ids limits read_one items evicted, None evicts them all.
+        Cached query results for the table are always evicted.
+        create_*, update_* and destroy_* call this for us, call it
+        yourself after writing with execute.
+        Our process evicts right away. For uncommitted writes (commit=False,
+        or inside a RequestConnection transaction) the other processes are
+        only told once they are committed, otherwise one could cache the
+        old row in between.
+        """
+        if self.cache is None or self.table_tag is None:
+            return
+        if ids is not None:
+            ids = [int(iid) for iid in ids if iid is not None]
+        if self.in_transaction():
+            self.cache.evict(self.table_tag, ids)
+            self.request_conn.defer_invalidation(self.cache, self.table_tag, ids)
+        elif not commit:
+            self.cache.evict(self.table_tag, ids)
+            self.pending_invalidations.append((self.cache, self.table_tag, ids))
+        else:
+            self.cache.invalidate(self.table_tag, ids)
+
+    def in_transaction(self):
+        """True while our RequestConnection has a transaction open.
+        We neither read nor fill the cache then, the shared cache must
+        not see uncommitted rows and we must see our own writes.
+        """
+        return self.request_conn is not None and self.request_conn.in_transaction
+
+    def flush_invalidations(self):
+        """publish invalidations held back until our commit"""
+        pending = self.pending_invalidations
+        self.pending_invalidations = []
+        for (cache, table_tag, ids) in pending:
+            cache.invalidate(table_tag, ids)
+
+    def bind(self, request_conn):
+        """use request_conn (a RequestConnection) for all our queries,
+        None goes back to checking connections out of our db_pool
+        """
+        self.request_conn = request_conn
+        if request_conn is not None:
+            self.db_pool = request_conn.db_pool
+
     def get_db_pool(self):
-        """get our db_pool (gevent.queue.Queue)"""
+        """get our db_pool (DbPool or gevent.queue.Queue)"""
         return self.db_pool
 
-    def get_db_conn(self):
-        """Make sure we have a db connection, and return it"""
+    def get_db_conn(self, bulk=False):
+        """Make sure we have a db connection, and return it.
+        bulk=True takes one from our bulk pool, if we have BULK settings,
+        unless our RequestConnection has a transaction open.
+        """
         db_conn = None
+        if bulk and not self.in_transaction():
+            bulk_pool = self.get_bulk_pool()
+            if bulk_pool is not None:
+                logging.debug('MySqlQueryset get_db_conn getting db_conn from bulk pool')
+                return self._ping_db_conn(bulk_pool.get(), bulk_pool)
+        if self.request_conn is not None:
+            # checked out (and pinged) once per request
+            return self.request_conn.get()
+        if self.db_conn is not None and is_db_conn_inherited(self.db_conn):
+            # we were forked, never share our parent's socket
+            logging.debug('MySqlQueryset get_db_conn dropping inherited db_conn')
+            self.db_conn = None
         if self.db_conn is None and self.db_pool is None:
             logging.debug('MySqlQueryset get_db_conn db_conn and db_pool is None')
             self.init_db_conn()
@@ -135,7 +268,12 @@ class MySqlQueryset(object):
             # Will block until one becomes available
             logging.debug('MySqlQueryset get_db_conn getting db_conn from pool')
             db_conn = self.db_pool.get()
+        return self._ping_db_conn(db_conn, self.db_pool)
 
+    def _ping_db_conn(self, db_conn, db_pool):
+        """Make sure db_conn (from db_pool, if any) still works,
+        replacing it with a new connection if it does not.
+        """
         if not db_conn is None:
             # try to avoid broken pipe error
             try:
@@ -143,6 +281,8 @@ class MySqlQueryset(object):
             except:
                 # if we have any problems just give us a fresh connection
                 logging.debug("Error pinging, building new connection")
+                is_own = db_conn is self.db_conn
+                bad_db_conn = db_conn
                 # first kill our old connection
                 if isinstance(db_conn, Connection):
                     try:
@@ -154,47 +294,77 @@ class MySqlQueryset(object):
                     ## create our mySql connection
                     ## this connection just takes
                     ## the old connections place in the queue
-                    db_conn = pymysql.connect(
-                        host = self.settings["CONNECTION"]["HOST"],
-                        port = self.settings["CONNECTION"]["PORT"],
-                        user = self.settings["CONNECTION"]["USER"],
-                        passwd = self.settings["CONNECTION"]["PASSWORD"],
-                        db = self.settings["CONNECTION"]["DATABASE"],
-                    );
+                    if isinstance(db_pool, DbPool) and not is_own:
+                        db_conn = db_pool.replace(bad_db_conn)
+                    else:
+                        db_conn = get_reconnect_manager(self.settings).connect()
+                    if is_own:
+                        self.db_conn = db_conn
                     logging.debug("created db_conn to replace bad")
-                    pass
                 except Exception:
                     logging.debug("error creating db_conn to replace bad")
                     raise
         return db_conn
 
+    def get_reconnect_manager(self):
+        """the ReconnectManager shared by our pool, limits reconnect storms"""
+        if isinstance(self.db_pool, DbPool):
+            return self.db_pool.reconnect
+        return get_reconnect_manager(self.settings)
+
     def commit(self):
         """commits any uncommited transactions"""
+        if self.in_transaction():
+            # the transaction belongs to the request, so do its invalidations
+            self.request_conn.commit()
+            self.flush_invalidations()
+            return
         try:
             self.get_db_conn().commit()
         except Exception as e:
-            pass
+            # nothing is committed, keep the invalidations for the next commit
+            return
+        self.flush_invalidations()
 
-    def return_db_conn(self, db_conn):
+    def return_db_conn(self, db_conn, bulk=False):
         """Puts a connection back in the pool.
-        Relies on gevent (db_pool is a Queue).
         Does nothing if we have no db_pool.
         """
-        if not self.db_pool is None:
+        if (self.request_conn is not None and
+            db_conn is self.request_conn.db_conn):
+            # it stays checked out until the request is done
+            return
+        if bulk and self.get_bulk_pool() is not None:
+            self.bulk_pool.put_nowait(db_conn)
+        elif not self.db_pool is None:
             self.db_pool.put_nowait(db_conn)
 
-    def init_db_pool(self, pool_size=10):
+    def get_bulk_pool(self):
+        """our pool for bulk reads, shared in this process unless set with
+        set_bulk_pool. None if we have no BULK settings.
+        """
+        if self.bulk_pool is None:
+            self.bulk_pool = get_bulk_db_pool(self.settings)
+        return self.bulk_pool
+
+    def set_bulk_pool(self, bulk_pool):
+        """set our pool for bulk reads (see BULK in base.py)"""
+        self.bulk_pool = bulk_pool
+
+    def set_bulk(self, bulk):
+        """bulk=True makes every query use our bulk pool by default"""
+        self.bulk = bulk
+
+    def init_db_pool(self, pool_size=None):
         """create our MySQL connections pool.
-        Queue used for pool relies on gevent.
+        The POOL settings MODE selects a gevent or thread-safe pool.
         """
         logging.debug("init_db_pool")
         try:
             # Only create it if it doesn't exist
             if self.db_conn is None and self.db_pool is None:
                 logging.debug("need to create new db_pool")
-                self.db_pool = gevent.queue.Queue()
-                for i in range(pool_size):
-                    self.db_pool.put_nowait(create_db_conn(self.settings))
+                self.db_pool = create_db_conn_pool(self.settings, pool_size)
             else:
                 logging.debug("NOT creating db_pool")
         except Exception:
@@ -279,6 +449,9 @@ class MySqlQueryset(object):
         """performs an insert, update or delete"""
         if commit is None:
             commit = self.auto_commit
+        if self.in_transaction():
+            # the transaction's owner commits or rolls back
+            commit = False
         #logging.debug("execute")
         affected_rows = 0
         inserted_id = None
@@ -305,12 +478,26 @@ class MySqlQueryset(object):
             return (affected_rows, inserted_id)
         return affected_rows
 
-    def query(self, sql, args=None, format=FORMAT_DICT, fetch_one=False, include_field_names=False):
+    def query(self, sql, args=None, format=FORMAT_DICT, fetch_one=False, include_field_names=False,
+              cache=False, decode=True, bulk=None):
         """performs a query.
            Defaults to returning a dict object, since that is what a DICT models and JSON need
+           cache=True keeps a copy of the result in our QueryCache (if enabled) until our table changes.
+           decode=True runs our FIELDS decoders over dict results (see decode_rows).
+           bulk=True runs on our bulk pool (see BULK in base.py), defaults to set_bulk.
         """
+        if bulk is None:
+            bulk = self.bulk
         #logging.debug("query")
-        db_conn = self.get_db_conn()
+        cache_key = None
+        if (cache and self.cache is not None and self.table_tag is not None and
+            not self.in_transaction()):
+            cache_key = self.cache.query_key(self.table_tag,
+                (sql, repr(args), format, fetch_one, include_field_names))
+            result = self.cache.get(cache_key)
+            if result is not None:
+                return result
+        db_conn = self.get_db_conn(bulk)
         sql = self.escape_sql(sql, args, db_conn)
         cursor = None
         rows = None
@@ -319,6 +506,7 @@ class MySqlQueryset(object):
             cursor = db_conn.cursor()
         else:
             cursor = db_conn.cursor(cursors.DictCursor)
+        started = time.time()
         try:
             cursor.execute(sql)
             if fetch_one == True:
@@ -336,11 +524,55 @@ class MySqlQueryset(object):
         finally:
             if cursor is not None:
                 cursor.close()
-            self.return_db_conn(db_conn)
+            self.return_db_conn(db_conn, bulk)
+        if self.profiler is not None:
+            self.profiler.observe(self.table_tag, sql, time.time() - started)
+        if decode and format != self.FORMAT_TUPLE:
+            rows = self.decode_rows(rows)
         if field_names:
-            return (rows, field_names)
+            result = (rows, field_names)
         else:
+            result = rows
+        if cache_key is not None and result is not None:
+            self.cache.set(cache_key, result)
+        return result
+
+    def get_field_decoders(self):
+        """(column, decoder) for every FIELDS entry with a "decode".
+        The column is the field's alias if it has one, like in our selects.
+        """
+        if self._decoders_fields is not self.fields:
+            decoders = []
+            for field in self.fields or []:
+                if isinstance(field, dict) and 'decode' in field:
+                    decoder = field['decode']
+                    if not callable(decoder):
+                        if decoder not in DECODERS:
+                            raise Exception("unknown decode %s for field %s" %
+                                            (decoder, field['name']))
+                        decoder = DECODERS[decoder]
+                    decoders.append((field.get('alias', field['name']), decoder))
+            self._decoders = decoders
+            self._decoders_fields = self.fields
+        return self._decoders
+
+    def decode_rows(self, rows):
+        """Decode a dict row, or a batch of them, in place.
+        We go column by column so each decoder runs once per batch.
+        """
+        decoders = self.get_field_decoders()
+        if rows is None or len(decoders) == 0:
             return rows
+        batch = [rows] if isinstance(rows, dict) else rows
+        for (column, decoder) in decoders:
+            decode_rows = [row for row in batch
+                           if row.get(column) is not None]
+            if len(decode_rows) == 0:
+                continue
+            values = decoder([row[column] for row in decode_rows])
+            for (row, value) in zip(decode_rows, values):
+                row[column] = value
+        return rows
 
     def fetch(self, sql, args=None, format=FORMAT_DICT):
         """gets just one item, the first returned"""
@@ -350,13 +582,40 @@ class MySqlQueryset(object):
             return None
         return  row
 
-    def get_select_fields_list(self, alias = None):
-        return self.get_fields_list(alias, 'select')
+    def get_select_fields_list(self, alias = None, only = None, defer = None):
+        return self.get_fields_list(alias, 'select',
+                                    self.get_projected_fields(only, defer))
 
-    def get_fields_list(self, alias = None, action = None):
-        """Creates a MySQL safe list of field names"""
+    def get_projected_fields(self, only = None, defer = None):
+        """Our fields limited to those named in only and not named in defer.
+        Fields can be named by their name or their alias.
+        """
         if self.fields is None:
             raise Exception("attribute fields not set in queryset!")
+        if only is None and defer is None:
+            return self.fields
+        def names(field):
+            if isinstance(field, dict):
+                return (field['name'], field.get('alias', field['name']))
+            return (field, field)
+        fields = self.fields
+        if only is not None:
+            fields = [field for field in fields
+                      if len(set(names(field)) & set(only)) > 0]
+        if defer is not None:
+            fields = [field for field in fields
+                      if len(set(names(field)) & set(defer)) == 0]
+        if len(fields) == 0:
+            raise Exception("no fields left to select with only=%s, defer=%s" %
+                            (only, defer))
+        return fields
+
+    def get_fields_list(self, alias = None, action = None, fields = None):
+        """Creates a MySQL safe list of field names"""
+        if fields is None:
+            fields = self.fields
+        if fields is None:
+            raise Exception("attribute fields not set in queryset!")
 
         if alias is not None:
             alias = '`%s`.' % alias
@@ -387,7 +646,7 @@ class MySqlQueryset(object):
             return field
 
         # map each item in the list and return us
-        fields_list = ','.join(map(wrap_and_join, self.fields))
+        fields_list = ','.join(map(wrap_and_join, fields))
         return fields_list
 
     def get_table_name(self):
@@ -708,6 +967,7 @@ class MySqlApiQueryset(MySqlQueryset, AbstractQueryset):
         if not inserted_id is None:
             shield.id = inserted_id
             logging.debug("inserted_id: %s)" % (inserted_id))
+        self.invalidate([shield.id], commit)
         return (status, shield)
 
     def create_many(self, shields, **kw):
@@ -717,30 +977,140 @@ class MySqlApiQueryset(MySqlQueryset, AbstractQueryset):
 
     ## Read Functions
 
-    def read_all(self, **kw):
+    def read_all(self, only = None, defer = None, bulk = None,
+                 order_by_id = False, **kw):
         table_name = self.table_name if not 'table_name' in kw else kw['table_name']
-        return [(self.MSG_OK, datum) for datum in self.query(u"SELECT %s FROM `%s`" % (self.get_select_fields_list(), table_name))]
+        sql = u"SELECT %s FROM `%s`" % (self.get_select_fields_list(only = only, defer = defer), table_name)
+        if order_by_id:
+            sql += u" ORDER BY `id`"
+        return [(self.MSG_OK, datum) for datum in self.query(sql, bulk = bulk)]
 
-    def read_one(self, iid, **kw):
+    def read_one(self, iid, only = None, defer = None, **kw):
         logging.debug("MySqlApiQueryset read_one")
         table_name = self.table_name if not 'table_name' in kw else kw['table_name']
          # be pesimistic, alway assume failure
         status = self.MSG_FAILED
         iid = int(iid)  # id is always an int in MySQL
-        sql = u"SELECT %s FROM `%s` WHERE ID = %%s" % (self.get_select_fields_list(), table_name)
+        cache_key = None
+        # we only cache whole items
+        if (self.cache is not None and self.table_tag is not None and
+            not 'table_name' in kw and only is None and defer is None and
+            not self.in_transaction()):
+            cache_key = self.cache.item_key(self.table_tag, iid)
+            item = self.cache.get(cache_key)
+            if not item is None:
+                return (self.MSG_OK, item)
+        sql = u"SELECT %s FROM `%s` WHERE ID = %%s" % (self.get_select_fields_list(only = only, defer = defer), table_name)
         #logging.debug("sql: %s" % sql)
         item = self.fetch(sql, [iid])
         if not item is None:
+            if cache_key is not None:
+                self.cache.set(cache_key, item)
             return (self.MSG_OK, item)
         return (status, iid)
 
     def read_many(self, ids, **kw):
         try:
-            table_name = self.table_name if not 'table_name' in kw else kw['table_name']
-            return [self.read_one(iid, table_name) for iid in ids]
+            # read_one picks up table_name, only and defer from kw
+            return [self.read_one(iid, **kw) for iid in ids]
         except KeyError:
             raise FourOhFourException
 
+    def read_in(self, ids, only = None, defer = None, **kw):
+        """read_many in one WHERE id IN (...) query, results are like
+        read_one's and in the order of ids. Cached items are not queried.
+        Falls back to read_many if id is not among the selected fields.
+        """
+        logging.debug("MySqlApiQueryset read_in")
+        id_alias = self.get_id_alias(only = only, defer = defer)
+        if id_alias is None:
+            return self.read_many(ids, only = only, defer = defer, **kw)
+        table_name = self.table_name if not 'table_name' in kw else kw['table_name']
+        ids = [int(iid) for iid in ids]  # id is always an int in MySQL
+        use_cache = (self.cache is not None and self.table_tag is not None and
+                     not 'table_name' in kw and only is None and defer is None and
+                     not self.in_transaction())
+        found = {}
+        if use_cache:
+            for iid in set(ids):
+                item = self.cache.get(self.cache.item_key(self.table_tag, iid))
+                if item is not None:
+                    found[iid] = item
+        missing = list(set(ids) - set(found.keys()))
+        if len(missing) > 0:
+            sql = u"SELECT %s FROM `%s` WHERE id IN (%s)" % (
+                self.get_select_fields_list(only = only, defer = defer), table_name,
+                ','.join(['%s'] * len(missing)))
+            for item in self.query(sql, missing):
+                iid = int(item[id_alias])
+                found[iid] = item
+                if use_cache:
+                    self.cache.set(self.cache.item_key(self.table_tag, iid), item)
+        return [(self.MSG_OK, found[iid]) if iid in found else (self.MSG_FAILED, iid)
+                for iid in ids]
+
+    def get_id_alias(self, only = None, defer = None):
+        """the key id is read back under, None if id is not selected"""
+        for field in self.get_projected_fields(only = only, defer = defer):
+            if isinstance(field, dict):
+                if field['name'] == 'id':
+                    return field.get('alias', 'id')
+            elif field == 'id':
+                return 'id'
+        return None
+
+    def get_filters_sql(self, filters):
+        """Creates a MySQL WHERE clause from a dict of field names to values.
+        A list or tuple value matches any of its items.
+        returns a tuple containing:
+            1. The format string for the sql
+            2. A list of the values themselves
+        """
+        if filters is None or len(filters) == 0:
+            return (u'', [])
+        clauses = []
+        values = []
+        for (field, value) in sorted(filters.items()):
+            if '`' in field:
+                raise Exception("invalid field name in filters: %s" % field)
+            if isinstance(value, (list, tuple)):
+                if len(value) == 0:
+                    # nothing can match an empty IN list
+                    clauses.append(u'0 = 1')
+                    continue
+                clauses.append(u'`%s` IN (%s)' % (field, ','.join(['%s'] * len(value))))
+                values.extend(value)
+            elif value is None:
+                clauses.append(u'`%s` IS NULL' % field)
+            else:
+                clauses.append(u'`%s` = %%s' % field)
+                values.append(value)
+        return (u' WHERE ' + u' AND '.join(clauses), values)
+
+    def count(self, filters = None, **kw):
+        """count the rows matching filters (see get_filters_sql), in one query"""
+        logging.debug("MySqlApiQueryset count")
+        table_name = self.table_name if not 'table_name' in kw else kw['table_name']
+        where = self.get_filters_sql(filters)
+        sql = u"SELECT count(*) FROM `%s`%s" % (table_name, where[0])
+        row = self.query(sql, where[1], self.FORMAT_TUPLE, True)
+        if row is None:
+            return 0
+        return int(row[0])
+
+    def exists_many(self, ids, **kw):
+        """check which ids exist in one query, returns a list of booleans
+        in the order of ids
+        """
+        logging.debug("MySqlApiQueryset exists_many")
+        table_name = self.table_name if not 'table_name' in kw else kw['table_name']
+        ids = [int(iid) for iid in ids]  # id is always an int in MySQL
+        if len(ids) == 0:
+            return []
+        sql = u"SELECT id FROM `%s` WHERE id IN (%s)" % (table_name, ','.join(['%s'] * len(ids)))
+        found = set([int(row[0]) for row in self.query(sql, ids, self.FORMAT_TUPLE)])
+        return [iid in found for iid in ids]
+
     ## Update Functions
 
     def update_one(self, shield, commit = None, **kw):
@@ -759,6 +1129,7 @@ class MySqlApiQueryset(MySqlQueryset, AbstractQueryset):
                         is_insert = False, is_insert_update = False,
                         commit = commit):
             status = self.MSG_CREATED
+        self.invalidate([shield.id], commit)
         return (status, shield)
 
     def update_many(self, shields, **kw):
@@ -781,9 +1152,11 @@ class MySqlApiQueryset(MySqlQueryset, AbstractQueryset):
                 DELETE FROM `%s`
                 WHERE id = %%s LIMIT 1
             """ % (table_name)
-            if self.execute(sql, [iid],
+            affected_rows = self.execute(sql, [iid],
                             is_insert = False, is_insert_update = False,
-                            commit = commit):
+                            commit = commit)
+            self.invalidate([iid], commit)
+            if affected_rows:
                 return (self.MSG_UPDATED, iid)
         except KeyError:
             raise FourOhFourException
@@ -797,3 +1170,189 @@ class MySqlApiQueryset(MySqlQueryset, AbstractQueryset):
     ###
     ### end functions nedded for auto API
     ###
+
+
+###
+### Sharding, route items to one of many MySQL backends by id
+###
+
+def hash_shard(iid, shard_count):
+    """default shard function, spreads integer ids evenly by modulo"""
+    return int(iid) % shard_count
+
+def range_shard(upper_bounds):
+    """create a shard function from a sorted list of exclusive upper id bounds.
+    range_shard([1000000, 2000000]) puts ids below 1000000 in shard 0,
+    below 2000000 in shard 1 and everything else in shard 2.
+    """
+    def shard_func(iid, shard_count):
+        shard = bisect.bisect_right(upper_bounds, int(iid))
+        if shard >= shard_count:
+            raise Exception("id %s is beyond our last shard" % iid)
+        return shard
+    return shard_func
+
+
+class ShardedMySqlApiQueryset(MySqlApiQueryset):
+    """A MySqlApiQueryset spread over several MySQL backends.
+
+    settings["SHARDS"] is a list of CONNECTION blocks, each shard gets its
+    own pool, shared by every queryset made from the same settings in this
+    process unless db_pools is given. Single item calls are routed to the shard owning the id,
+    calls for many items scatter to every shard involved in parallel
+    and gather the results back in the order they were asked for.
+
+    shard_func(iid, shard_count) returns the index of the owning shard,
+    hash_shard is the default, range_shard builds range based ones.
+    Ids must be assigned by the application, auto increment ids are not
+    unique across shards.
+    """
+
+    # the queryset class used to talk to each shard
+    shard_queryset_class = MySqlApiQueryset
+
+    def __init__(self, settings, db_pools = None, table_tag = None,
+                 auto_commit = None, shard_func = None):
+        """load our settings and create a queryset for each shard"""
+        logging.debug("ShardedMySqlApiQueryset for %s initializing" % table_tag)
+        super(ShardedMySqlApiQueryset, self).__init__(settings, None,
+                                                      table_tag, auto_commit)
+        if shard_func is None:
+            shard_func = hash_shard
+        self.shard_func = shard_func
+        self.mode = settings.get("POOL", {}).get("MODE", POOL_MODE_GEVENT)
+        if db_pools is None:
+            db_pools = get_shard_db_pools(settings)
+        shard_settings = get_shard_settings(settings)
+        if len(db_pools) != len(shard_settings):
+            raise Exception("need one db_pool per shard, got %s for %s shards" %
+                            (len(db_pools), len(shard_settings)))
+        self.shards = [self.shard_queryset_class(shard_settings[i], db_pools[i],
+                                                 table_tag, self.auto_commit)
+                       for i in range(len(shard_settings))]
+        # all shards share our cache
+        for shard in self.shards:
+            shard.set_cache(self.cache)
+
+    def get_db_conn(self, bulk=False):
+        """we have no connection of our own, each shard has its pool"""
+        raise Exception("ShardedMySqlApiQueryset has no db_conn, use get_shard(iid)")
+
+    def commit(self):
+        """commit on every shard in parallel, each publishes the
+        invalidations it held back
+        """
+        run_parallel([lambda shard=shard: shard.commit()
+                      for shard in self.shards], self.mode)
+        self.flush_invalidations()
+
+    def get_shard_index(self, iid):
+        return self.shard_func(iid, len(self.shards))
+
+    def get_shard(self, iid):
+        """the queryset for the shard owning iid"""
+        return self.shards[self.get_shard_index(iid)]
+
+    def _scatter(self, items, key, func):
+        """group items by shard (using key to find the id), run
+        func(shard, shard_items) for every shard involved in parallel
+        and gather the per item results back in the order of items.
+        """
+        groups = {}
+        for position, item in enumerate(items):
+            shard_index = self.get_shard_index(key(item))
+            groups.setdefault(shard_index, []).append((position, item))
+        shard_indexes = sorted(groups.keys())
+        shard_results = run_parallel([
+            lambda i=i: func(self.shards[i], [item for (p, item) in groups[i]])
+            for i in shard_indexes], self.mode)
+        results = [None] * len(items)
+        for i, shard_result in zip(shard_indexes, shard_results):
+            for (position, item), result in zip(groups[i], shard_result):
+                results[position] = result
+        return results
+
+    def query_shards(self, sql, args=None, format=MySqlQueryset.FORMAT_DICT):
+        """run the same query on every shard in parallel and concatenate
+        the rows in shard order
+        """
+        shard_rows = run_parallel([
+            lambda shard=shard: shard.query(sql, args, format)
+            for shard in self.shards], self.mode)
+        rows = []
+        for shard_row in shard_rows:
+            rows.extend(shard_row)
+        return rows
+
+    def _shield_id(self, shield):
+        if shield.id is None:
+            raise Exception("ShardedMySqlApiQueryset needs an id to route to a shard")
+        return shield.id
+
+    ## Create Functions
+
+    def create_one(self, shield, commit = None, **kw):
+        return self.get_shard(self._shield_id(shield)).create_one(shield, commit, **kw)
+
+    def create_many(self, shields, **kw):
+        return self._scatter(shields, self._shield_id,
+                             lambda shard, items: shard.create_many(items, **kw))
+
+    ## Read Functions
+
+    def read_all(self, only = None, defer = None, **kw):
+        """every shard reads its rows ordered by id in parallel, the sorted
+        streams are merged so items come back ordered by id across shards.
+        Without id among the selected fields rows come back in shard order.
+        """
+        id_alias = self.get_id_alias(only = only, defer = defer)
+        shard_items = run_parallel([
+            lambda shard=shard: shard.read_all(only = only, defer = defer,
+                                               order_by_id = id_alias is not None,
+                                               **kw)
+            for shard in self.shards], self.mode)
+        if id_alias is None:
+            items = []
+            for shard_item in shard_items:
+                items.extend(shard_item)
+            return items
+        # decorate with (id, shard, position), heapq.merge takes no key
+        # and the tie breakers keep it from ever comparing the items
+        streams = [[((item[1][id_alias], i, n), item)
+                    for n, item in enumerate(shard_items[i])]
+                   for i in range(len(shard_items))]
+        return [item for (sort_key, item) in heapq.merge(*streams)]
+
+    def read_one(self, iid, **kw):
+        return self.get_shard(iid).read_one(iid, **kw)
+
+    def read_many(self, ids, **kw):
+        return self._scatter(ids, lambda iid: iid,
+                             lambda shard, items: shard.read_in(items, **kw))
+
+    def count(self, filters = None, **kw):
+        return sum(run_parallel([
+            lambda shard=shard: shard.count(filters, **kw)
+            for shard in self.shards], self.mode))
+
+    def exists_many(self, ids, **kw):
+        return self._scatter(ids, lambda iid: iid,
+                             lambda shard, items: shard.exists_many(items, **kw))
+
+    ## Update Functions
+
+    def update_one(self, shield, commit = None, **kw):
+        return self.get_shard(self._shield_id(shield)).update_one(shield, commit, **kw)
+
+    def update_many(self, shields, **kw):
+        return self._scatter(shields, self._shield_id,
+                             lambda shard, items: shard.update_many(items, **kw))
+
+    ## Destroy Functions
+
+    def destroy_one(self, iid, commit = None, **kw):
+        return self.get_shard(iid).destroy_one(iid, commit, **kw)
+
+    def destroy_many(self, ids, commit = None, **kw):
+        return self._scatter(ids, lambda iid: iid,
+                             lambda shard, items: shard.destroy_many(items, commit, **kw))
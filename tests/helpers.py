@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import os
+import sys
+import time
+import threading
+
+# the package uses implicit relative imports (from base import ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "brubeckmysql"))
+
+import pymysql
+
+##
+## Shared helpers for the tests, a stand-in for pymysql.connect so pools,
+## reconnects and caches can be tested without a MySQL server.
+##
+
+
+def make_settings(**blocks):
+    """a settings dict in thread mode, blocks override the defaults"""
+    settings = {
+        "CONNECTION": {
+            "HOST": "127.0.0.1",
+            "PORT": 3306,
+            "USER": "test",
+            "PASSWORD": "test",
+            "DATABASE": "test",
+            "COLLATION": "utf8",
+        },
+        "POOL": {"SIZE": 2, "MODE": "thread"},
+        "RECONNECT": {"BACKOFF_BASE": 0.0, "BACKOFF_MAX": 0.0},
+    }
+    settings.update(blocks)
+    return settings
+
+
+class FakeCursor(object):
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+
+    def execute(self, sql):
+        self.db_conn.executed.append(sql)
+        return 0
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """just enough of a pymysql connection for the pool"""
+
+    def __init__(self, number):
+        self.number = number
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def ping(self, *args):
+        pass
+
+    def cursor(self, *args):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnect(object):
+    """Replaces pymysql.connect. fail makes the next calls raise,
+    delay makes each call take that long.
+    """
+
+    def __init__(self, fail=0, delay=0.0):
+        self.fail = fail
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, **kw):
+        with self._lock:
+            self.calls += 1
+            number = self.calls
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if self.fail > 0:
+                self.fail -= 1
+                raise pymysql.err.OperationalError(2003, "can't connect")
+            return FakeConnection(number)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def patch_connect(test, fake=None):
+    """swap pymysql.connect for fake (a new FakeConnect by default)
+    for the rest of test
+    """
+    if fake is None:
+        fake = FakeConnect()
+    original = pymysql.connect
+    pymysql.connect = fake
+    test.addCleanup(setattr, pymysql, "connect", original)
+    return fake
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+
+from helpers import make_settings, patch_connect
+
+from base import DbPool
+from base import RequestConnection
+import cache
+from cache import InvalidationBus
+from cache import QueryCache
+from cache import UnixSocketTransport
+
+
+def make_cache(**cache_settings):
+    settings = make_settings(CACHE=dict({"ENABLED": True, "TRANSPORT": "local"},
+                                        **cache_settings))
+    return QueryCache(settings)
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def test_items_are_copied(self):
+        query_cache = make_cache()
+        key = query_cache.item_key("users", 1)
+        item = {"id": 1, "name": "ann", "tags": ["a"]}
+        query_cache.set(key, item)
+        item["name"] = "changed before"
+        got = query_cache.get(key)
+        got["name"] = "changed after"
+        got["tags"].append("b")
+        self.assertEqual(query_cache.get(key), {"id": 1, "name": "ann", "tags": ["a"]})
+
+    def test_query_results_are_copied(self):
+        query_cache = make_cache()
+        key = query_cache.query_key("users", ("SELECT * FROM users",))
+        query_cache.set(key, [{"id": 1}])
+        query_cache.get(key).append({"id": 2})
+        self.assertEqual(query_cache.get(key), [{"id": 1}])
+
+    def test_evict_ids_and_table_queries(self):
+        query_cache = make_cache()
+        query_cache.set(query_cache.item_key("users", 1), {"id": 1})
+        query_cache.set(query_cache.item_key("users", 2), {"id": 2})
+        query_cache.set(query_cache.query_key("users", "all"), [])
+        query_cache.set(query_cache.item_key("groups", 1), {"id": 1})
+        query_cache.evict("users", [1])
+        self.assertIsNone(query_cache.get(query_cache.item_key("users", 1)))
+        self.assertIsNotNone(query_cache.get(query_cache.item_key("users", 2)))
+        self.assertIsNone(query_cache.get(query_cache.query_key("users", "all")))
+        self.assertIsNotNone(query_cache.get(query_cache.item_key("groups", 1)))
+        query_cache.evict("users")
+        self.assertIsNone(query_cache.get(query_cache.item_key("users", 2)))
+
+    def test_lru_eviction_forgets_query_keys(self):
+        query_cache = make_cache(MAX_ITEMS=10)
+        for i in range(50):
+            query_cache.set(query_cache.query_key("users", i), [])
+        self.assertEqual(len(query_cache._items), 10)
+        self.assertEqual(len(query_cache._queries["users"]), 10)
+
+    def test_ttl(self):
+        query_cache = make_cache(TTL=0.01)
+        key = query_cache.item_key("users", 1)
+        query_cache.set(key, {"id": 1})
+        time.sleep(0.02)
+        self.assertIsNone(query_cache.get(key))
+        self.assertEqual(len(query_cache._items), 0)
+
+    def test_invalidate_goes_through_the_bus(self):
+        query_cache = make_cache()
+        key = query_cache.item_key("users", 1)
+        query_cache.set(key, {"id": 1})
+        query_cache.invalidate("users", [1])
+        self.assertIsNone(query_cache.get(key))
+        query_cache.set(key, {"id": 1})
+        # the local transport delivers our own message back to us
+        query_cache.bus.flush()
+        self.assertIsNone(query_cache.get(key))
+
+
+class InvalidationBusTest(unittest.TestCase):
+
+    def setUp(self):
+        settings = make_settings(CACHE={"TRANSPORT": "local", "FLUSH_INTERVAL": 60})
+        self.bus = InvalidationBus(settings)
+        self.received = []
+        self.bus.subscribe(lambda table_tag, ids: self.received.append((table_tag, ids)))
+
+    def test_coalesces_until_flushed(self):
+        self.bus.publish("users", [1])
+        self.bus.publish("users", [2])
+        self.bus.publish("groups")
+        self.assertEqual(self.received, [])
+        self.bus.flush()
+        received = dict(self.received)
+        self.assertEqual(sorted(received["users"]), [1, 2])
+        self.assertIsNone(received["groups"])
+
+    def test_payloads_stay_under_max_payload(self):
+        pending = dict(("table%s" % i, set(range(1000))) for i in range(20))
+        payloads = self.bus._payloads(pending)
+        self.assertTrue(len(payloads) > 1)
+        tables = []
+        for payload in payloads:
+            self.assertTrue(len(payload) <= cache.MAX_PAYLOAD)
+            tables.extend([table_tag for table_tag, ids in json.loads(payload.decode("utf8"))])
+        self.assertEqual(sorted(tables), sorted(pending.keys()))
+
+    def test_too_many_ids_invalidate_the_table(self):
+        payloads = self.bus._payloads({"users": set(range(100000))})
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(json.loads(payloads[0].decode("utf8")), [["users", None]])
+
+
+class UnixSocketTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+
+    def test_send_does_not_block_on_a_full_peer(self):
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(stuck.close)
+        stuck.bind(os.path.join(self.socket_dir, "1.sock"))
+        transport = UnixSocketTransport(make_settings(CACHE={"SOCKET_DIR": self.socket_dir}))
+        started = time.time()
+        for i in range(2000):
+            transport.send(b"[]")
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(transport.dropped > 0)
+
+    def test_removes_sockets_of_dead_processes(self):
+        path = os.path.join(self.socket_dir, "1.sock")
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        dead.bind(path)
+        dead.close()
+        transport = UnixSocketTransport(make_settings(CACHE={"SOCKET_DIR": self.socket_dir}))
+        transport.send(b"[]")
+        self.assertFalse(os.path.exists(path))
+
+
+class FakeCache(object):
+    """records what a RequestConnection does with its invalidations"""
+
+    def __init__(self):
+        self.invalidated = []
+        self.evicted = []
+
+    def invalidate(self, table_tag, ids):
+        self.invalidated.append((table_tag, ids))
+
+    def evict(self, table_tag, ids):
+        self.evicted.append((table_tag, ids))
+
+
+class RequestConnectionInvalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        patch_connect(self)
+        self.pool = DbPool(make_settings())
+        self.request_conn = RequestConnection(self.pool)
+        self.cache = FakeCache()
+
+    def test_publishes_after_commit(self):
+        self.request_conn.begin()
+        self.request_conn.defer_invalidation(self.cache, "users", [1])
+        self.assertEqual(self.cache.invalidated, [])
+        self.request_conn.commit()
+        self.assertEqual(self.cache.invalidated, [("users", [1])])
+        self.assertEqual(self.request_conn.db_conn.commits, 1)
+        self.assertEqual(self.request_conn.pending_invalidations, [])
+
+    def test_failed_commit_publishes_nothing(self):
+        self.request_conn.begin()
+        self.request_conn.defer_invalidation(self.cache, "users", [1])
+        def fail():
+            raise Exception("lost connection")
+        self.request_conn.db_conn.commit = fail
+        self.assertRaises(Exception, self.request_conn.commit)
+        self.assertEqual(self.cache.invalidated, [])
+
+    def test_rollback_drops_invalidations(self):
+        self.request_conn.begin()
+        self.request_conn.defer_invalidation(self.cache, "users", [1])
+        self.request_conn.rollback()
+        self.assertEqual(self.cache.invalidated, [])
+        self.assertEqual(self.request_conn.pending_invalidations, [])
+        self.assertFalse(self.request_conn.in_transaction)
+
+    def test_release_rolls_back_and_returns_the_connection(self):
+        self.request_conn.begin()
+        db_conn = self.request_conn.db_conn
+        self.request_conn.defer_invalidation(self.cache, "users", [1])
+        self.request_conn.release()
+        self.assertEqual(db_conn.rollbacks, 1)
+        self.assertEqual(self.cache.invalidated, [])
+        self.assertIs(self.pool.get(), db_conn)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import os
+import time
+import threading
+import unittest
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import gevent
+
+from helpers import make_settings, patch_connect
+
+from base import DbPool
+
+
+class DbPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = patch_connect(self)
+        self.pool = DbPool(make_settings())
+
+    def test_connects_lazily_up_to_size(self):
+        self.assertEqual(self.connect.calls, 0)
+        first = self.pool.get()
+        second = self.pool.get()
+        self.assertEqual(self.connect.calls, 2)
+        self.assertEqual(self.pool.created, 2)
+        self.pool.put(first)
+        self.assertIs(self.pool.get(), first)
+        self.assertEqual(self.connect.calls, 2)
+        self.pool.put(second)
+
+    def test_get_times_out_when_full(self):
+        self.pool.get()
+        self.pool.get()
+        self.assertRaises(queue.Empty, self.pool.get, True, 0.05)
+        self.assertEqual(self.pool.waiting, 0)
+
+    def test_freed_slot_wakes_a_waiter(self):
+        first = self.pool.get()
+        self.pool.get()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.pool.get(timeout=2)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(self.pool.waiting, 1)
+        self.pool.discard(first)
+        waiter.join()
+        self.assertEqual(len(got), 1)
+        self.assertIsNot(got[0], first)
+        self.assertEqual(self.pool.created, 2)
+
+    def test_free_slots_are_not_idle_connections(self):
+        db_conn = self.pool.get()
+        self.pool.discard(db_conn)
+        self.assertEqual(self.pool.created, 0)
+        self.assertEqual(self.pool.qsize(), 0)
+        self.assertTrue(self.pool.empty())
+
+    def test_failed_connect_frees_the_slot(self):
+        self.connect.fail = 10
+        self.assertRaises(Exception, self.pool.get)
+        self.assertEqual(self.pool.created, 0)
+
+    def test_fill(self):
+        self.pool.fill()
+        self.assertEqual(self.pool.created, 2)
+        self.assertEqual(self.pool.qsize(), 2)
+
+    def test_close_discards_idle_connections(self):
+        db_conn = self.pool.get()
+        self.pool.put(db_conn)
+        self.pool.close()
+        self.assertTrue(db_conn.closed)
+        self.assertEqual(self.pool.created, 0)
+
+    def test_rebuilds_after_fork(self):
+        parent_conn = self.pool.get()
+        # pretend we are the forked child
+        self.pool.pid = -1
+        child_conn = self.pool.get()
+        self.assertIsNot(child_conn, parent_conn)
+        self.assertEqual(self.pool.pid, os.getpid())
+        self.assertEqual(self.pool.created, 1)
+
+    def test_drops_inherited_connections(self):
+        db_conn = self.pool.get()
+        db_conn.creator_pid = -1
+        self.pool.put(db_conn)
+        self.assertEqual(self.pool.qsize(), 0)
+        self.assertFalse(db_conn.closed)
+
+
+class GeventDbPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = patch_connect(self)
+        settings = make_settings()
+        settings["POOL"]["MODE"] = "gevent"
+        self.pool = DbPool(settings)
+
+    def test_freed_slot_wakes_a_waiter(self):
+        first = self.pool.get()
+        self.pool.get()
+        waiter = gevent.spawn(self.pool.get, True, 2)
+        gevent.sleep(0)
+        self.assertEqual(self.pool.waiting, 1)
+        self.pool.discard(first)
+        waiter.join()
+        self.assertTrue(waiter.successful())
+        self.assertIsNot(waiter.value, first)
+        self.assertEqual(self.pool.qsize(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
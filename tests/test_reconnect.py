@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2012 Brooklyn Code Incorporated. See LICENSE.md for usage
+# the license can also be found at http://brooklyncode.com/opensource/LICENSE.md
+
+import time
+import threading
+import unittest
+
+from helpers import make_settings, patch_connect
+
+from base import ReconnectManager
+from base import CircuitOpenException
+from base import ConfigurationException
+from base import CIRCUIT_CLOSED
+from base import CIRCUIT_OPEN
+
+
+class ReconnectManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = patch_connect(self)
+        self.settings = make_settings()
+        self.settings["RECONNECT"].update({
+            "MAX_RETRIES": 3,
+            "FAILURE_THRESHOLD": 5,
+            "RESET_TIMEOUT": 60.0,
+        })
+        self.manager = ReconnectManager(self.settings)
+
+    def test_retries_until_connected(self):
+        self.connect.fail = 2
+        self.assertIsNotNone(self.manager.connect())
+        stats = self.manager.stats()
+        self.assertEqual(stats["attempts"], 3)
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["successes"], 1)
+        self.assertEqual(stats["consecutive_failures"], 0)
+
+    def test_gives_up_after_max_retries(self):
+        self.connect.fail = 10
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertEqual(self.connect.calls, 3)
+        self.assertEqual(self.manager.state, CIRCUIT_CLOSED)
+
+    def test_circuit_opens_and_fails_fast(self):
+        self.connect.fail = 10
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertEqual(self.manager.state, CIRCUIT_OPEN)
+        calls = self.connect.calls
+        self.assertRaises(CircuitOpenException, self.manager.connect)
+        self.assertEqual(self.connect.calls, calls)
+        self.assertEqual(self.manager.stats()["rejected"], 1)
+
+    def test_half_open_probe_closes_the_circuit(self):
+        self.connect.fail = 10
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertRaises(Exception, self.manager.connect)
+        self.manager.opened_at = time.time() - 61.0
+        self.connect.fail = 0
+        self.assertIsNotNone(self.manager.connect())
+        self.assertEqual(self.manager.state, CIRCUIT_CLOSED)
+        self.assertFalse(self.manager._probing)
+
+    def test_failed_probe_reopens_without_retrying(self):
+        self.connect.fail = 10
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertRaises(Exception, self.manager.connect)
+        self.manager.opened_at = time.time() - 61.0
+        calls = self.connect.calls
+        self.assertRaises(Exception, self.manager.connect)
+        self.assertEqual(self.connect.calls, calls + 1)
+        self.assertEqual(self.manager.state, CIRCUIT_OPEN)
+        self.assertFalse(self.manager._probing)
+
+    def test_limits_concurrent_attempts(self):
+        self.connect.delay = 0.02
+        workers = [threading.Thread(target=self.manager.connect) for i in range(6)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.connect.calls, 6)
+        self.assertEqual(self.connect.max_in_flight, 2)
+
+    def test_unlimited_connect_skips_max_concurrent(self):
+        self.connect.delay = 0.02
+        workers = [threading.Thread(target=self.manager.connect, args=(False,))
+                   for i in range(6)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertTrue(self.connect.max_in_flight > 2)
+
+    def test_bad_settings_are_not_retried_or_counted(self):
+        self.settings["CONNECTION"]["MAX_ALLOWED_PACKET"] = "lots"
+        for i in range(10):
+            self.assertRaises(ConfigurationException, self.manager.connect)
+        self.assertEqual(self.connect.calls, 0)
+        stats = self.manager.stats()
+        self.assertEqual(stats["attempts"], 0)
+        self.assertEqual(stats["failures"], 0)
+        self.assertEqual(stats["state"], CIRCUIT_CLOSED)
+
+
+if __name__ == "__main__":
+    unittest.main()